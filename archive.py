@@ -0,0 +1,25 @@
+import logging
+from datetime import datetime, timedelta
+from dotenv import dotenv_values
+
+from database import archive_printed_invoices, connect, vacuum
+
+logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+config = dotenv_values(".env")
+retention_days = int(config.get("INVOICE_RETENTION_DAYS", 90))
+archive_dir = config.get("INVOICE_ARCHIVE_DIR", "archive")
+
+invoices = connect()
+
+before = datetime.now() - timedelta(days=retention_days)
+
+logging.info("Archiving printed invoices saved before %s", before.isoformat())
+
+archived_count = archive_printed_invoices(invoices, before, archive_dir)
+
+logging.info("Archived %d invoices", archived_count)
+
+vacuum(invoices)
+
+logging.info("Vacuumed invoices database")
@@ -0,0 +1,439 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import unittest
+import zlib
+from datetime import datetime
+
+
+def now_iso():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def format_stage_time(moment):
+    return moment.isoformat(timespec="milliseconds") if moment else None
+
+
+def parse_stage_time(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def store_talao(connection, talao):
+    talao_hash = hashlib.sha256(talao).hexdigest()
+
+    connection.execute(
+        "insert or ignore into talao(hash, data) values (?, ?)",
+        (talao_hash, zlib.compress(talao, 9)),
+    )
+
+    return talao_hash
+
+
+def decompress_talao(data):
+    return zlib.decompress(data)
+
+
+def load_talao(connection, talao_hash):
+    cursor = connection.execute(
+        "select data from talao where hash = (?)", (talao_hash,)
+    )
+    (data,) = cursor.fetchone()
+
+    return decompress_talao(data)
+
+
+legacy_import_mark = "legacy_invoices"
+
+
+def _split_taloes(connection):
+    connection.execute("create table talao(hash text primary key, data blob not null)")
+    connection.execute("""
+        create table invoice_split(
+          id int primary key,
+          delivery_code text unique,
+          talao_hash text not null references talao(hash),
+          print_id text,
+          saved_at text not null
+        )
+        """)
+
+    migrated_at = now_iso()
+    rows = connection.execute("select id, delivery_code, talao, print_id from invoice")
+
+    for _id, code, talao, print_id in rows:
+        connection.execute(
+            "insert into invoice_split(id, delivery_code, talao_hash, print_id, saved_at) values (?, ?, ?, ?, ?)",
+            (_id, code, store_talao(connection, talao), print_id, migrated_at),
+        )
+
+    connection.execute(
+        "insert or replace into import_mark(name, document_id) select (?), coalesce(max(id), 0) from invoice_split",
+        (legacy_import_mark,),
+    )
+    connection.execute("drop table invoice")
+    connection.execute("alter table invoice_split rename to invoice")
+    connection.execute(
+        "create index invoice_unprinted on invoice(id) where print_id is null"
+    )
+    connection.execute("create index invoice_saved_at on invoice(saved_at)")
+
+
+def _add_invoice_metadata(connection):
+    for column in ("number", "amount_gross", "local_time", "type"):
+        connection.execute(f"alter table invoice add column {column} text")
+
+    connection.execute(
+        "create index invoice_manual_local_time on invoice(local_time) where delivery_code is null"
+    )
+
+
+stage_columns = (
+    "started_at",
+    "seen_at",
+    "invoiced_at",
+    "talao_fetched_at",
+    "printed_at",
+)
+
+
+def _add_stage_timestamps(connection):
+    for column in stage_columns:
+        connection.execute(f"alter table invoice add column {column} text")
+
+
+legacy_facility_id = "ec411c9b-34b2-391d-9d61-fbc9ef40fc8c"
+legacy_register_id = 94305980
+
+invoice_columns = (
+    "id",
+    "facility_id",
+    "delivery_code",
+    "talao_hash",
+    "print_id",
+    "saved_at",
+    "number",
+    "amount_gross",
+    "local_time",
+    "type",
+) + stage_columns
+
+print_columns = ("platform", "station", "printer", "print_state")
+
+
+def _partition_by_facility(connection):
+    connection.execute("""
+        create table invoice_partitioned(
+          id int primary key,
+          facility_id text not null,
+          delivery_code text,
+          talao_hash text not null references talao(hash),
+          print_id text,
+          saved_at text not null,
+          number text,
+          amount_gross text,
+          local_time text,
+          type text,
+          started_at text,
+          seen_at text,
+          invoiced_at text,
+          talao_fetched_at text,
+          printed_at text,
+          unique(facility_id, delivery_code)
+        )
+        """)
+
+    columns = ", ".join(
+        ("id", "delivery_code", "talao_hash", "print_id", "saved_at")
+        + ("number", "amount_gross", "local_time", "type")
+        + stage_columns
+    )
+
+    connection.execute(
+        f"insert into invoice_partitioned(facility_id, {columns}) select (?), {columns} from invoice",
+        (legacy_facility_id,),
+    )
+    connection.execute("drop table invoice")
+    connection.execute("alter table invoice_partitioned rename to invoice")
+    connection.execute(
+        "create index invoice_unprinted on invoice(facility_id, id) where print_id is null"
+    )
+    connection.execute("create index invoice_saved_at on invoice(saved_at)")
+    connection.execute(
+        "create index invoice_manual_local_time on invoice(facility_id, local_time) where delivery_code is null"
+    )
+    connection.execute(
+        "update import_mark set name = (?) where name = 'manual_invoices'",
+        (f"manual_invoices:{legacy_register_id}",),
+    )
+
+
+def _track_print_jobs(connection):
+    for column in print_columns:
+        connection.execute(f"alter table invoice add column {column} text")
+
+    connection.execute(
+        "update invoice set print_state = 'printed' where print_id is not null"
+    )
+    connection.execute("drop index invoice_unprinted")
+    connection.execute(
+        "create index invoice_unprinted on invoice(facility_id, id) where print_state is null"
+    )
+    connection.execute(
+        "create index invoice_unconfirmed on invoice(facility_id, id) where print_state = 'queued'"
+    )
+
+
+def _add_invoice_intents(connection):
+    connection.execute("""
+        create table invoice_intent(
+          facility_id text not null,
+          delivery_code text not null,
+          intended_at text not null,
+          document_id int,
+          primary key(facility_id, delivery_code)
+        )
+        """)
+
+
+def _index_talao_references(connection):
+    connection.execute("create index invoice_talao_hash on invoice(talao_hash)")
+
+
+_migrations = [
+    _split_taloes,
+    _add_invoice_metadata,
+    _add_stage_timestamps,
+    _partition_by_facility,
+    _track_print_jobs,
+    _add_invoice_intents,
+    _index_talao_references,
+]
+
+
+def _create_schema(connection, schema_path):
+    with open(schema_path) as schema_file:
+        schema = schema_file.read()
+
+    logging.info("Creating invoices database version %d", len(_migrations))
+
+    connection.executescript(
+        f"begin immediate;\n{schema}\npragma user_version = {len(_migrations)};\ncommit;"
+    )
+
+
+def apply_schema(connection, schema_path="invoice.sql"):
+    (version,) = connection.execute("pragma user_version").fetchone()
+    has_invoices = connection.execute(
+        "select 1 from sqlite_master where type = 'table' and name = 'invoice'"
+    ).fetchone()
+
+    if version == 0 and not has_invoices:
+        _create_schema(connection, schema_path)
+    elif version == 0:
+        connection.execute(
+            "create table if not exists import_mark(name string primary key, document_id int not null)"
+        )
+
+    while True:
+        connection.execute("begin immediate")
+
+        try:
+            (version,) = connection.execute("pragma user_version").fetchone()
+
+            if version >= len(_migrations):
+                connection.rollback()
+
+                return
+
+            logging.info("Migrating invoices database to version %d", version + 1)
+
+            _migrations[version](connection)
+            connection.execute(f"pragma user_version = {version + 1}")
+
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+
+            raise
+
+
+def _create_archive_tables(connection):
+    connection.execute(
+        "create table if not exists archive.talao(hash text primary key, data blob not null)"
+    )
+    connection.execute("""
+        create table if not exists archive.invoice(
+          id int primary key,
+          delivery_code text,
+          talao_hash text not null,
+          print_id text,
+          saved_at text not null,
+          number text,
+          amount_gross text,
+          local_time text,
+          type text
+        )
+        """)
+
+    archived_columns = {
+        name for _, name, *_ in connection.execute("pragma archive.table_info(invoice)")
+    }
+
+    for column in invoice_columns + print_columns:
+        if column not in archived_columns:
+            connection.execute(f"alter table archive.invoice add column {column} text")
+
+
+def archive_printed_invoices(connection, before, archive_dir="archive"):
+    os.makedirs(archive_dir, exist_ok=True)
+
+    cutoff = before.isoformat(timespec="seconds")
+    months = [
+        month
+        for (month,) in connection.execute(
+            "select distinct substr(saved_at, 1, 7) from invoice where saved_at < (?) and print_state = 'printed'",
+            (cutoff,),
+        )
+    ]
+
+    archived_count = 0
+
+    for month in months:
+        archive_path = os.path.join(archive_dir, f"invoices-{month}.db")
+        connection.execute("attach database (?) as archive", (archive_path,))
+
+        try:
+            connection.execute("begin immediate")
+
+            try:
+                _create_archive_tables(connection)
+
+                columns = ", ".join(invoice_columns + print_columns)
+                archived_filter = "saved_at < (?) and print_state = 'printed' and substr(saved_at, 1, 7) = (?)"
+                filter_params = (cutoff, month)
+
+                connection.execute(
+                    f"insert or ignore into archive.talao(hash, data) select hash, data from talao where hash in (select talao_hash from invoice where {archived_filter})",
+                    filter_params,
+                )
+                cursor = connection.execute(
+                    f"insert or ignore into archive.invoice({columns}) select {columns} from invoice where {archived_filter}",
+                    filter_params,
+                )
+                archived_count += cursor.rowcount
+
+                connection.execute(
+                    f"delete from invoice where {archived_filter}", filter_params
+                )
+                connection.execute(
+                    "delete from talao where hash not in (select talao_hash from invoice)"
+                )
+
+                connection.commit()
+            except BaseException:
+                connection.rollback()
+
+                raise
+        finally:
+            connection.execute("detach database archive")
+
+        logging.info("Archived invoices from %s into %s", month, archive_path)
+
+    return archived_count
+
+
+def vacuum(connection):
+    (auto_vacuum,) = connection.execute("pragma auto_vacuum").fetchone()
+
+    if auto_vacuum != 2:
+        logging.info("Enabling incremental vacuum")
+
+        connection.execute("pragma auto_vacuum = incremental")
+        connection.execute("vacuum")
+    else:
+        connection.execute("pragma incremental_vacuum")
+
+
+def connect(database_path="invoices.db", busy_timeout_seconds=30):
+    connection = sqlite3.connect(database_path, timeout=busy_timeout_seconds)
+
+    connection.execute("pragma journal_mode = wal")
+    apply_schema(connection)
+
+    return connection
+
+
+class TestArchivePrintedInvoices(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.archive_dir = os.path.join(self.directory.name, "archive")
+        self.connection = connect(os.path.join(self.directory.name, "invoices.db"))
+
+    def tearDown(self):
+        self.connection.close()
+        self.directory.cleanup()
+
+    def save_invoice(self, _id, saved_at, print_state, talao):
+        self.connection.execute(
+            "insert into invoice(id, facility_id, talao_hash, saved_at, print_state) values (?, 'f', ?, ?, ?)",
+            (_id, store_talao(self.connection, talao), saved_at, print_state),
+        )
+        self.connection.commit()
+
+    def read_archive(self, month):
+        with sqlite3.connect(
+            os.path.join(self.archive_dir, f"invoices-{month}.db")
+        ) as archive:
+            invoice_ids = [
+                _id for (_id,) in archive.execute("select id from invoice order by id")
+            ]
+            taloes = {
+                decompress_talao(data)
+                for (data,) in archive.execute("select data from talao")
+            }
+
+        return invoice_ids, taloes
+
+    def test_moves_printed_invoices_into_monthly_archives(self):
+        self.save_invoice(1, "2026-08-20T12:00:00", "printed", b"august")
+        self.save_invoice(2, "2026-08-21T12:00:00", "queued", b"queued")
+        self.save_invoice(3, "2026-09-10T12:00:00", "printed", b"shared")
+        self.save_invoice(4, "2026-09-11T12:00:00", None, b"shared")
+        self.save_invoice(5, "2026-09-12T12:00:00", "printed", b"september")
+        self.save_invoice(6, "2026-10-05T12:00:00", "printed", b"october")
+
+        archived_count = archive_printed_invoices(
+            self.connection, datetime(2026, 10, 1), self.archive_dir
+        )
+
+        self.assertEqual(archived_count, 3)
+        self.assertEqual(
+            self.connection.execute(
+                "select id, print_state from invoice order by id"
+            ).fetchall(),
+            [(2, "queued"), (4, None), (6, "printed")],
+        )
+        self.assertEqual(
+            {
+                decompress_talao(data)
+                for (data,) in self.connection.execute("select data from talao")
+            },
+            {b"queued", b"shared", b"october"},
+        )
+        self.assertEqual(self.read_archive("2026-08"), ([1], {b"august"}))
+        self.assertEqual(
+            self.read_archive("2026-09"), ([3, 5], {b"shared", b"september"})
+        )
+        self.assertEqual(
+            sorted(os.listdir(self.archive_dir)),
+            ["invoices-2026-08.db", "invoices-2026-09.db"],
+        )
+
+        vacuum(self.connection)
+
+        self.assertEqual(self.connection.execute("pragma auto_vacuum").fetchone(), (2,))
+        self.assertEqual(
+            self.connection.execute("pragma integrity_check").fetchone(), ("ok",)
+        )
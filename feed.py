@@ -0,0 +1,402 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import unittest
+from urllib.parse import parse_qs, urlsplit
+from dotenv import dotenv_values
+
+from metrics import registry
+from snapshot import watch_snapshots
+from wakeup import FEED_WAKEUP_PATH
+from runtime import Topic, single_instance
+from sites import load_sites
+
+_static_files = {
+    "/": ("frontOfHouse.html", "text/html; charset=utf-8"),
+    "/frontOfHouse.html": ("frontOfHouse.html", "text/html; charset=utf-8"),
+    "/frontOfHouse.js": ("frontOfHouse.js", "text/javascript; charset=utf-8"),
+    "/style.css": ("style.css", "text/css; charset=utf-8"),
+}
+
+_status_reasons = {
+    200: "OK",
+    304: "Not Modified",
+    404: "Not Found",
+    405: "Method Not Allowed",
+}
+
+
+def _encode_json(data):
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def _encode_event(event, data):
+    encoded_data = _encode_json(data).decode("utf-8")
+
+    return f"event: {event}\ndata: {encoded_data}\n\n".encode("utf-8")
+
+
+class Resource:
+    def __init__(self, body, content_type):
+        self.body = body
+        self.gzipped_body = gzip.compress(body)
+        self.content_type = content_type
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:20]}"'
+
+
+class StaticFiles:
+    def __init__(self, files):
+        self.files = files
+        self.cache = {}
+
+    def get(self, path):
+        try:
+            file_path, content_type = self.files[path]
+            stat = os.stat(file_path)
+        except (KeyError, FileNotFoundError):
+            return None
+
+        file_stat = (stat.st_mtime_ns, stat.st_size)
+        cached = self.cache.get(path)
+
+        if cached and cached[0] == file_stat:
+            return cached[1]
+
+        with open(file_path, "rb") as static_file:
+            resource = Resource(static_file.read(), content_type)
+
+        self.cache[path] = (file_stat, resource)
+
+        return resource
+
+
+class OrdersFeed:
+    def __init__(self, topics, events_topics=None):
+        self.topics = topics
+        self.events_topics = events_topics or {}
+        self.orders = {source: {} for source in topics}
+        self.resources = {}
+        self.subscribers = set()
+
+    def _diff(self, source, orders):
+        previous_orders = self.orders[source]
+        current_orders = {order["code"]: order for order in orders}
+
+        self.orders[source] = current_orders
+
+        return {
+            "source": source,
+            "upserted": [
+                order
+                for code, order in current_orders.items()
+                if previous_orders.get(code) != order
+            ],
+            "removed": [code for code in previous_orders if code not in current_orders],
+        }
+
+    def _apply(self, source, events):
+        current_orders = self.orders[source]
+        upserted = events["added"] + events["changed"]
+
+        for order in upserted:
+            current_orders[order["code"]] = order
+
+        for code in events["removed"]:
+            current_orders.pop(code, None)
+
+        return {"source": source, "upserted": upserted, "removed": events["removed"]}
+
+    def update(self, source, sequence, orders, events=None):
+        self.resources[source] = Resource(
+            _encode_json({"sequence": sequence, "orders": orders}),
+            "application/json",
+        )
+
+        if events is None:
+            delta = self._diff(source, orders)
+        else:
+            delta = self._apply(source, events)
+
+        if delta["upserted"] or delta["removed"]:
+            logging.debug(
+                "Broadcasting %s delta to %d screens", source, len(self.subscribers)
+            )
+
+            self._broadcast(_encode_event("delta", delta))
+
+    async def _follow_topic(self, source, topic):
+        version = 0
+
+        while True:
+            await topic.wait_newer(version)
+            version = topic.version
+
+            self.update(source, version, topic.value)
+
+    async def _follow_events(self, source, topic, events_topic):
+        version = 0
+        sequence = 0
+
+        while True:
+            await events_topic.wait_newer(version)
+            version = events_topic.version
+            events = events_topic.value
+
+            if events["sequence"] == sequence + 1 == topic.version:
+                self.update(source, topic.version, topic.value, events)
+            else:
+                self.update(source, topic.version, topic.value)
+
+            sequence = topic.version
+
+    async def follow(self):
+        await asyncio.gather(
+            *(
+                (
+                    self._follow_events(source, topic, self.events_topics[source])
+                    if source in self.events_topics
+                    else self._follow_topic(source, topic)
+                )
+                for source, topic in self.topics.items()
+            )
+        )
+
+    def _broadcast(self, message):
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.put_nowait(message)
+            except asyncio.QueueFull:
+                logging.warning("Dropping slow screen subscriber")
+
+                self.subscribers.discard(subscriber)
+
+    def snapshot_event(self):
+        return _encode_event(
+            "snapshot",
+            {source: list(orders.values()) for source, orders in self.orders.items()},
+        )
+
+    def subscribe(self):
+        subscriber = asyncio.Queue(maxsize=100)
+        self.subscribers.add(subscriber)
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+
+class FeedServer:
+    def __init__(self, feeds, static_files, heartbeat_seconds=15):
+        self.feeds = feeds
+        self.default_site = next(iter(feeds))
+        self.static_files = static_files
+        self.heartbeat_seconds = heartbeat_seconds
+
+    def _select_feed(self, query):
+        site = parse_qs(query).get("site", [self.default_site])[0]
+
+        return self.feeds.get(site)
+
+    def _get_resource(self, path, feed):
+        if path in {"/orders.json", "/manual_orders.json"}:
+            return feed and feed.resources.get(path[1:].removesuffix(".json"))
+
+        if path == "/metrics":
+            return Resource(
+                registry.render().encode("utf-8"), "text/plain; version=0.0.4"
+            )
+
+        return self.static_files.get(path)
+
+    async def _send(self, writer, status, headers, body=b""):
+        head = [f"HTTP/1.1 {status} {_status_reasons[status]}"]
+        head += [f"{name}: {value}" for name, value in headers.items()]
+
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def _send_resource(self, writer, method, request_headers, resource):
+        if method not in {"GET", "HEAD"}:
+            await self._send(writer, 405, {"Allow": "GET, HEAD", "Content-Length": 0})
+            return
+
+        if resource is None:
+            await self._send(writer, 404, {"Content-Length": 0})
+            return
+
+        headers = {
+            "ETag": resource.etag,
+            "Cache-Control": "no-cache",
+            "Vary": "Accept-Encoding",
+        }
+
+        if request_headers.get("if-none-match") == resource.etag:
+            await self._send(writer, 304, headers)
+            return
+
+        body = resource.body
+        if "gzip" in request_headers.get("accept-encoding", ""):
+            body = resource.gzipped_body
+            headers["Content-Encoding"] = "gzip"
+
+        headers["Content-Type"] = resource.content_type
+        headers["Content-Length"] = len(body)
+
+        await self._send(writer, 200, headers, body if method == "GET" else b"")
+
+    async def _stream_events(self, writer, feed):
+        subscriber = feed.subscribe()
+
+        try:
+            await self._send(
+                writer,
+                200,
+                {
+                    "Content-Type": "text/event-stream",
+                    "Cache-Control": "no-cache",
+                    "Connection": "keep-alive",
+                },
+                feed.snapshot_event(),
+            )
+
+            while subscriber in feed.subscribers:
+                try:
+                    message = await asyncio.wait_for(
+                        subscriber.get(), self.heartbeat_seconds
+                    )
+                except asyncio.TimeoutError:
+                    message = b": heartbeat\n\n"
+
+                writer.write(message)
+                await writer.drain()
+        finally:
+            feed.unsubscribe(subscriber)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while request_line := await reader.readline():
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+
+                request_headers = {}
+                while (line := await reader.readline()) not in {b"\r\n", b"\n", b""}:
+                    name, _, value = line.decode("latin-1").partition(":")
+                    request_headers[name.strip().lower()] = value.strip()
+
+                url = urlsplit(target)
+                feed = self._select_feed(url.query)
+
+                if url.path == "/events" and feed:
+                    await self._stream_events(writer, feed)
+                    break
+
+                await self._send_resource(
+                    writer, method, request_headers, self._get_resource(url.path, feed)
+                )
+
+                if request_headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(feeds, host, port):
+    server = FeedServer(feeds, StaticFiles(_static_files))
+    http_server = await asyncio.start_server(server.handle_connection, host, port)
+
+    logging.info("Serving front of house on %s:%d", host, port)
+
+    async with http_server:
+        await asyncio.gather(*(feed.follow() for feed in feeds.values()))
+
+
+class TestOrdersFeed(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.topic = Topic()
+        self.events_topic = Topic()
+        self.feed = OrdersFeed({"orders": self.topic}, {"orders": self.events_topic})
+        self.subscriber = self.feed.subscribe()
+        self.following = asyncio.create_task(self.feed.follow())
+        await asyncio.sleep(0)
+
+    async def asyncTearDown(self):
+        self.following.cancel()
+
+    async def publish(self, orders, events):
+        self.topic.publish(orders)
+        self.events_topic.publish({"sequence": self.topic.version, **events})
+        await asyncio.sleep(0)
+
+    def next_delta(self):
+        message = self.subscriber.get_nowait().decode("utf-8")
+        event, data = message.strip().split("\n")
+
+        self.assertEqual(event, "event: delta")
+
+        return json.loads(data.removeprefix("data: "))
+
+    async def test_broadcasts_poller_events(self):
+        a, b = {"code": "A", "completed": False}, {"code": "B", "completed": False}
+        await self.publish([a, b], {"added": [a, b], "changed": [], "removed": []})
+
+        self.assertEqual(self.next_delta()["upserted"], [a, b])
+
+        a = {**a, "completed": True}
+        await self.publish([a], {"added": [], "changed": [a], "removed": ["B"]})
+
+        self.assertEqual(
+            self.next_delta(), {"source": "orders", "upserted": [a], "removed": ["B"]}
+        )
+        self.assertEqual(self.feed.orders["orders"], {"A": a})
+
+    async def test_diffs_orders_after_missed_events(self):
+        a, b = {"code": "A", "completed": False}, {"code": "B", "completed": False}
+        self.topic.publish([a])
+        self.events_topic.publish(
+            {"sequence": 1, "added": [a], "changed": [], "removed": []}
+        )
+        await self.publish([b], {"added": [b], "changed": [], "removed": ["A"]})
+
+        self.assertEqual(
+            self.next_delta(), {"source": "orders", "upserted": [b], "removed": []}
+        )
+        self.assertEqual(self.feed.orders["orders"], {"B": b})
+
+
+async def main():
+    config = dotenv_values(".env")
+
+    feeds = {}
+    watched_snapshots = {}
+
+    for site in load_sites(config):
+        orders_topic = Topic()
+        manual_orders_topic = Topic()
+
+        feeds[site.name] = OrdersFeed(
+            {"orders": orders_topic, "manual_orders": manual_orders_topic}
+        )
+        watched_snapshots[site.orders_path] = orders_topic
+        watched_snapshots[site.manual_orders_path] = manual_orders_topic
+
+    await asyncio.gather(
+        watch_snapshots(watched_snapshots, 2, FEED_WAKEUP_PATH),
+        serve(
+            feeds,
+            config.get("FEED_HOST", "0.0.0.0"),
+            int(config.get("FEED_PORT", 8000)),
+        ),
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+    me = single_instance("feed")
+
+    asyncio.run(main())
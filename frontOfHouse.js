@@ -177,34 +177,49 @@ function updateOrdersPage(ordersEl, orders, clock, alarmManager) {
   })
 }
 
-async function fetchOrders() {
-  function fetchJson(url) {
-    return fetch(url).then(res => res.json())
-  }
+function parseOrder(order) {
+  order.startDate = new Date(order.startDate)
+
+  return order
+}
+
+function subscribeOrders(onOrders) {
+  const ordersBySource = {}
+  const events = new EventSource('/events' + location.search)
 
-  const [orders, manualOrders] = await Promise.all([
-    fetchJson('/orders.json'),
-    fetchJson('/manual_orders.json'),
-  ])
+  function publishOrders() {
+    const orders = Object.values(ordersBySource).flatMap(sourceOrders =>
+      Array.from(sourceOrders.values())
+    )
 
-  function parseOrder(order) {
-    order.startDate = new Date(order.startDate)
+    onOrders(orders)
   }
 
-  orders.push(...manualOrders)
-  orders.forEach(parseOrder)
+  events.addEventListener('snapshot', event => {
+    const snapshot = JSON.parse(event.data)
 
-  return orders
-}
+    for (const [source, orders] of Object.entries(snapshot)) {
+      ordersBySource[source] = new Map(orders.map(order => [order.code, parseOrder(order)]))
+    }
 
-async function refreshPage(ordersEl, clock, alarmManager) {
-  try {
-    const deliveryOrders = await fetchOrders()
+    publishOrders()
+  })
 
-    updateOrdersPage(ordersEl, deliveryOrders, clock, alarmManager)
-  } catch (error) {
-    console.error(error)
-  }
+  events.addEventListener('delta', event => {
+    const delta = JSON.parse(event.data)
+    const sourceOrders = ordersBySource[delta.source] || new Map()
+
+    delta.removed.forEach(code => sourceOrders.delete(code))
+    delta.upserted.forEach(order => sourceOrders.set(order.code, parseOrder(order)))
+
+    ordersBySource[delta.source] = sourceOrders
+
+    publishOrders()
+  })
+
+  events.onerror = error => console.error(error)
+
+  return events
 }
 
 function setUpStartPage(onStart) {
@@ -233,14 +248,12 @@ document.addEventListener('DOMContentLoaded', function () {
   }
   const alarmManager = new AlarmManager(alarmConfig)
 
-  const refreshOrdersSeconds = 2
-
   const ordersEl = document.getElementById('orders')
 
   function startFrontOfHouse() {
-    doRepeat(() => {
-      refreshPage(ordersEl, clock, alarmManager)
-    }, refreshOrdersSeconds * 1000)
+    subscribeOrders(orders => {
+      updateOrdersPage(ordersEl, orders, clock, alarmManager)
+    })
   }
 
   setUpStartPage(startFrontOfHouse)
@@ -1,6 +1,46 @@
+create table if not exists talao(
+  hash text primary key,
+  data blob not null
+);
+
 create table if not exists invoice(
   id int primary key,
-  delivery_code string unique,
-  talao blob not null,
-  print_id string
+  facility_id text not null,
+  delivery_code text,
+  talao_hash text not null references talao(hash),
+  print_id text,
+  saved_at text not null,
+  number text,
+  amount_gross text,
+  local_time text,
+  type text,
+  started_at text,
+  seen_at text,
+  invoiced_at text,
+  talao_fetched_at text,
+  printed_at text,
+  platform text,
+  station text,
+  printer text,
+  print_state text,
+  unique(facility_id, delivery_code)
+);
+
+create table if not exists import_mark(
+  name string primary key,
+  document_id int not null
+);
+
+create table if not exists invoice_intent(
+  facility_id text not null,
+  delivery_code text not null,
+  intended_at text not null,
+  document_id int,
+  primary key(facility_id, delivery_code)
 );
+
+create index if not exists invoice_unprinted on invoice(facility_id, id) where print_state is null;
+create index if not exists invoice_unconfirmed on invoice(facility_id, id) where print_state = 'queued';
+create index if not exists invoice_saved_at on invoice(saved_at);
+create index if not exists invoice_manual_local_time on invoice(facility_id, local_time) where delivery_code is null;
+create index if not exists invoice_talao_hash on invoice(talao_hash);
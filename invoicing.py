@@ -1,18 +1,32 @@
+import asyncio
 import logging
-import sys
 import sqlite3
-from time import sleep
+import time
+import unittest
 from datetime import datetime
 import dateutil.parser
-from collections import Counter
-import json
-from json.decoder import JSONDecodeError
-from tendo import singleton
+import requests
+from operator import itemgetter
+from unittest import mock
 from dotenv import dotenv_values
 
-from otter import convert_google_money
-from vendus import VendusClient, InvoiceItem, InvoiceModifier
+from otter import google_money_cents
+from vendus import (
+    AsyncVendusClient,
+    InvoiceItem,
+    InvoiceModifier,
+    format_cents,
+    total_cents,
+)
 from stack import stack_items
+from mapping import InvoiceMapping, InvoiceMappingFile
+from snapshot import watch_snapshots
+from wakeup import signal_wakeups
+from database import connect, format_stage_time, now_iso, store_talao
+from metrics import loop_seconds, observe_stages
+from runtime import Topic, single_instance
+from sites import Site, load_sites
+from scheduler import PollScheduler, create_opening_hours
 from nif import search as search_nif
 
 
@@ -45,7 +59,7 @@ def generate_invoice_items(ticket, invoice_item_mapping):
                 if not ignore_modifier:
                     invoice_modifier = InvoiceModifier(
                         reference=modifier_reference,
-                        price=convert_google_money(
+                        price_cents=google_money_cents(
                             modifier_price["units"], modifier_price["nanos"]
                         ),
                         quantity=modifier_quantity,
@@ -56,18 +70,15 @@ def generate_invoice_items(ticket, invoice_item_mapping):
 
             yield InvoiceItem(
                 reference=item_reference,
-                price=convert_google_money(item_price["units"], item_price["nanos"]),
+                price_cents=google_money_cents(
+                    item_price["units"], item_price["nanos"]
+                ),
                 quantity=item_quantity,
                 note=item_note,
                 modifiers=tuple(invoice_modifiers),
             )
 
 
-def read_json(file_path):
-    with open(file_path) as orders_file:
-        return json.load(orders_file)
-
-
 def find_nif(ticket):
     nifs = search_nif(ticket["customerNote"] or "")
 
@@ -77,209 +88,826 @@ def find_nif(ticket):
         return None
 
 
-def was_delivery_invoiced(code):
-    cursor = invoices.cursor()
+def is_rejection(response):
+    return (
+        response is not None
+        and 400 <= response.status_code < 500
+        and response.status_code not in (408, 409)
+    )
 
-    cursor.execute("select * from invoice where delivery_code = (?)", (code,))
 
-    return cursor.fetchone() is not None
+def get_invoice_local_time(invoice):
+    local_time = invoice.get("local_time")
 
+    if isinstance(local_time, datetime):
+        return local_time.isoformat()
 
-def was_invoice_saved(_id):
-    cursor = invoices.cursor()
+    try:
+        return dateutil.parser.parse(local_time).isoformat()
+    except (TypeError, ValueError, OverflowError):
+        return now_iso()
+
+
+class Invoicer:
+    def __init__(
+        self,
+        vendus,
+        invoices,
+        site,
+        saved_topic,
+        concurrency=4,
+        import_scheduler=None,
+        invoice_mapping_file=None,
+    ):
+        self.vendus = vendus
+        self.invoices = invoices
+        self.site = site
+        self.saved_topic = saved_topic
+        self.import_scheduler = import_scheduler or PollScheduler(
+            f"Vendus manual invoices {site.name}", busy_seconds=1, idle_seconds=2
+        )
 
-    cursor.execute("select * from invoice where id = (?)", (_id,))
+        self.invoicing_limit = asyncio.Semaphore(concurrency)
+        self.pending_tickets = {}
+        self.in_flight_tickets = {}
+        self.mismatched_codes = set()
+        self.unmapped_codes = set()
+        self.seen_at = {}
 
-    return cursor.fetchone() is not None
+        self.invoice_mapping_file = invoice_mapping_file or InvoiceMappingFile()
+        self.invoice_mapping = None
 
+        self.invoiced_codes = self.load_invoiced_codes()
 
-def save_invoice(_id, code, talao):
-    cursor = invoices.cursor()
+        logging.info(
+            "Loaded %d invoiced delivery codes for %s",
+            len(self.invoiced_codes),
+            site.name,
+        )
 
-    talao_blob = sqlite3.Binary(talao)
+    def load_invoiced_codes(self):
+        cursor = self.invoices.cursor()
 
-    cursor.execute(
-        "insert into invoice(id, delivery_code, talao, print_id) values (?, ?, ?, ?)",
-        (
-            _id,
-            code,
-            talao_blob,
-            None,
-        ),
-    )
+        cursor.execute(
+            "select delivery_code from invoice where facility_id = (?) and delivery_code is not null",
+            (self.site.facility_id,),
+        )
 
-    invoices.commit()
+        return {code for (code,) in cursor}
 
+    def was_delivery_invoiced(self, code):
+        if code in self.invoiced_codes:
+            return True
 
-def import_manual_invoices():
-    today_date = datetime.today().date()
-    invoices = invoicer.get_invoices()
+        cursor = self.invoices.cursor()
 
-    for invoice in invoices:
-        is_invoiced_today = invoice["date"] == today_date
-        is_delivery = "external_reference" in invoice
+        cursor.execute(
+            "select 1 from invoice where facility_id = (?) and delivery_code = (?) limit 1",
+            (self.site.facility_id, code),
+        )
 
-        if is_invoiced_today and not is_delivery:
-            invoice_id = invoice["id"]
+        was_invoiced = cursor.fetchone() is not None
+
+        if was_invoiced:
+            self.invoiced_codes.add(code)
+
+        return was_invoiced
+
+    def was_invoice_saved(self, _id):
+        cursor = self.invoices.cursor()
+
+        cursor.execute("select 1 from invoice where id = (?) limit 1", (_id,))
+
+        return cursor.fetchone() is not None
+
+    def save_invoice(self, _id, code, talao, invoice, stages=None, ticket=None):
+        cursor = self.invoices.cursor()
+        saved_at = datetime.now()
+        stages = {**(stages or {}), "saved_at": saved_at}
+
+        try:
+            talao_hash = store_talao(self.invoices, talao)
+
+            cursor.execute(
+                "insert into invoice(id, facility_id, delivery_code, talao_hash, print_id, saved_at, number, amount_gross, local_time, type, started_at, seen_at, invoiced_at, talao_fetched_at, platform, station) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    _id,
+                    self.site.facility_id,
+                    code,
+                    talao_hash,
+                    None,
+                    format_stage_time(saved_at),
+                    invoice.get("number"),
+                    invoice.get("amount_gross"),
+                    get_invoice_local_time(invoice),
+                    invoice.get("type"),
+                    *(
+                        format_stage_time(stages.get(stage))
+                        for stage in (
+                            "started_at",
+                            "seen_at",
+                            "invoiced_at",
+                            "talao_fetched_at",
+                        )
+                    ),
+                    ticket and ticket["platform"],
+                    ticket and ticket.get("station"),
+                ),
+            )
 
-            if not was_invoice_saved(invoice_id):
-                logging.info(
-                    "Found manual invoice %s %s %s",
-                    invoice_id,
-                    invoice["amount_gross"],
-                    invoice["local_time"].isoformat(),
+            if code is not None:
+                cursor.execute(
+                    "delete from invoice_intent where facility_id = (?) and delivery_code = (?)",
+                    (self.site.facility_id, code),
                 )
 
-                talao = invoicer.get_talao(invoice_id)
-                save_invoice(invoice_id, None, talao)
+            self.invoices.commit()
+        except BaseException:
+            self.invoices.rollback()
 
+            raise
 
-def invoice_delivery(items, code, platform, nif, name, phone_number, note):
-    notes = f"{name} ({platform}) {note}"
+        if code is not None:
+            self.invoiced_codes.add(code)
 
-    placeholder_address = "Address"
+        observe_stages(stages)
 
-    client = invoicer.guess_client(nif, phone_number, name)
-    if not client:
-        logging.info(
-            "Client not found, will create client %s %s %s", nif, name, phone_number
+        self.saved_topic.publish(_id)
+
+    def get_import_mark(self, name):
+        cursor = self.invoices.cursor()
+
+        cursor.execute("select document_id from import_mark where name = (?)", (name,))
+        row = cursor.fetchone()
+
+        return row[0] if row else 0
+
+    def set_import_mark(self, name, document_id):
+        cursor = self.invoices.cursor()
+
+        cursor.execute(
+            "insert or replace into import_mark(name, document_id) values (?, ?)",
+            (name, document_id),
         )
 
-        client = invoicer.create_client(
-            nif=nif,
-            name=name,
-            address=placeholder_address,
-            mobile=phone_number,
-            external_reference=phone_number,
+        self.invoices.commit()
+
+    async def import_manual_invoices(self):
+        today_date = datetime.today().date()
+        import_mark = f"manual_invoices:{self.site.register_id}"
+        last_document_id = self.get_import_mark(import_mark)
+
+        new_invoices = [
+            invoice
+            for invoice in await self.vendus.get_invoices(
+                since=today_date,
+                register_id=self.site.register_id,
+                newer_than_id=last_document_id,
+            )
+            if invoice["id"] > last_document_id
+            and int(invoice.get("register_id", self.site.register_id))
+            == self.site.register_id
+        ]
+
+        if not new_invoices:
+            return 0
+
+        manual_invoices = [
+            invoice
+            for invoice in sorted(new_invoices, key=itemgetter("id"))
+            if invoice["date"] == today_date
+            and "external_reference" not in invoice
+            and not self.was_invoice_saved(invoice["id"])
+        ]
+
+        taloes = await asyncio.gather(
+            *(self.vendus.get_talao(invoice["id"]) for invoice in manual_invoices)
         )
 
-        logging.info("Client created with id %d", client["id"])
+        for invoice, talao in zip(manual_invoices, taloes):
+            invoice_id = invoice["id"]
 
-    client_id = client["id"]
+            logging.info(
+                "Found manual invoice %s %s %s",
+                invoice_id,
+                invoice["amount_gross"],
+                invoice["local_time"].isoformat(),
+            )
 
-    logging.info("Will invoice for client %s", client_id)
+            self.save_invoice(invoice_id, None, talao, invoice)
 
-    invoice = invoicer.invoice(
-        items,
-        client_id=client_id,
-        config=invoice_config,
-        external_reference=code,
-        notes=notes,
-    )
+        self.set_import_mark(
+            import_mark, max(invoice["id"] for invoice in new_invoices)
+        )
 
-    return invoice
+        return len(manual_invoices)
 
+    async def invoice_delivery(
+        self, items, code, platform, nif, name, phone_number, note
+    ):
+        notes = f"{name} ({platform}) {note}"
 
-logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+        placeholder_address = "Address"
 
-logging.info("Starting invoicing")
+        client = await self.vendus.guess_client(nif, phone_number, name)
+        if not client:
+            logging.info(
+                "Client not found, will create client %s %s %s", nif, name, phone_number
+            )
 
-me = singleton.SingleInstance()
+            client = await self.vendus.create_client(
+                nif=nif,
+                name=name,
+                address=placeholder_address,
+                mobile=phone_number,
+                external_reference=phone_number,
+            )
 
-invoices = sqlite3.connect("invoices.db")
+            logging.info("Client created with id %d", client["id"])
 
-config = dotenv_values(".env")
-vendus_api_key = config["VENDUS_API_KEY"]
+        client_id = client["id"]
 
-invoice_config = {
-    "type": "FR",
-    "payments": [{"id": "94305968"}],
-    "register_id": 94305980,
-}
-invoicer = VendusClient(vendus_api_key)
+        logging.info("Will invoice for client %s", client_id)
 
-while True:
-    try:
-        import_manual_invoices()
-    except Exception:
-        logging.exception("Failed manual import. Will retry")
+        self.record_intent(code)
 
-    try:
-        invoice_mapping = read_json("invoicing.json")
-        invoice_item_mapping = invoice_mapping["items"]
-        sold_seperatly_references = frozenset(invoice_mapping["sold_seperatly"])
+        try:
+            invoice = await self.vendus.invoice(
+                items,
+                client_id=client_id,
+                config=self.site.invoice_config,
+                external_reference=code,
+                notes=notes,
+            )
+        except requests.HTTPError as e:
+            if is_rejection(e.response):
+                self.drop_intent(code)
 
-        tickets = read_json("orders.json")
+            raise
 
-        for ticket in tickets:
-            code = ticket["code"]
-            accepted = ticket["accepted"]
-            canceled = ticket["canceled"]
-            phone_number = ticket["customerPhone"]
+        return invoice
 
-            start_time_iso = ticket.get("startDate")
+    def is_ticket_invoiceable(self, ticket):
+        return (
+            ticket["accepted"]
+            and not ticket["canceled"]
+            and not self.was_delivery_invoiced(ticket["code"])
+        )
 
-            if accepted and not canceled and not was_delivery_invoiced(code):
-                try:
-                    if not start_time_iso:
-                        raise ValueError("Expects startDate on order")
+    def get_intent(self, code):
+        cursor = self.invoices.cursor()
 
-                    start_time = dateutil.parser.isoparse(start_time_iso).replace(
-                        tzinfo=None
-                    )
+        cursor.execute(
+            "select intended_at, document_id from invoice_intent where facility_id = (?) and delivery_code = (?)",
+            (self.site.facility_id, code),
+        )
 
-                    name = ticket["customerName"]
-                    platform = ticket["platform"]
-                    note = ticket["customerNote"]
-                    price = ticket["price"]
+        return cursor.fetchone()
 
-                    invoice_items = stack_items(
-                        generate_invoice_items(ticket, invoice_item_mapping),
-                        sold_seperatly_references,
-                    )
+    def record_intent(self, code):
+        try:
+            self.invoices.execute(
+                "insert or ignore into invoice_intent(facility_id, delivery_code, intended_at) values (?, ?, ?)",
+                (self.site.facility_id, code, now_iso()),
+            )
+            self.invoices.commit()
+        except BaseException:
+            self.invoices.rollback()
+
+            raise
 
-                    nif = find_nif(ticket)
+    def record_document(self, code, document_id):
+        try:
+            self.invoices.execute(
+                "update invoice_intent set document_id = (?) where facility_id = (?) and delivery_code = (?)",
+                (document_id, self.site.facility_id, code),
+            )
+            self.invoices.commit()
+        except BaseException:
+            self.invoices.rollback()
 
-                    logging.info("Will invoice %s items %s", code, invoice_items)
+            raise
 
-                    invoice = invoice_delivery(
-                        invoice_items,
-                        code,
-                        platform,
-                        nif,
-                        name,
-                        phone_number,
-                        note,
-                    )
+    def drop_intent(self, code):
+        try:
+            self.invoices.execute(
+                "delete from invoice_intent where facility_id = (?) and delivery_code = (?)",
+                (self.site.facility_id, code),
+            )
+            self.invoices.commit()
+        except BaseException:
+            self.invoices.rollback()
 
-                    invoiced_ammount = round(float(invoice["amount_gross"]), 2)
+            raise
 
-                    if invoiced_ammount != price:
-                        raise ValueError(
-                            f"Invoice ammount {invoiced_ammount} different from ticket price {price}"
-                        )
+    async def find_issued_invoice(self, code):
+        intent = self.get_intent(code)
 
-                    invoice_id = invoice["id"]
-                    talao = invoicer.get_talao(invoice_id)
+        if not intent:
+            return None
 
-                    logging.info("Invoiced %s - %s", code, invoice_id)
+        intended_at, document_id = intent
 
-                    try:
-                        save_invoice(invoice_id, code, talao)
-                    except Exception:
-                        logging.exception(
-                            "Invoice saved but failed to mark as invoiced"
-                        )
-                        sys.exit("Exited to prevent invoice duplication")
+        if document_id:
+            return await self.vendus.get_invoice_details(document_id)
+
+        for invoice in await self.vendus.get_invoices(
+            since=datetime.fromisoformat(intended_at).date(),
+            register_id=self.site.register_id,
+            external_reference=code,
+        ):
+            if invoice.get("external_reference") == code:
+                return invoice
+
+        return None
+
+    async def invoice_ticket(self, ticket, invoice_mapping):
+        async with self.invoicing_limit:
+            return await self._invoice_ticket(ticket, invoice_mapping)
+
+    async def _invoice_ticket(self, ticket, invoice_mapping):
+        code = ticket["code"]
+        phone_number = ticket["customerPhone"]
+
+        start_time_iso = ticket.get("startDate")
+
+        try:
+            if not start_time_iso:
+                raise ValueError("Expects startDate on order")
+
+            start_time = (
+                dateutil.parser.isoparse(start_time_iso)
+                .astimezone()
+                .replace(tzinfo=None)
+            )
+
+            name = ticket["customerName"]
+            platform = ticket["platform"]
+            note = ticket["customerNote"]
+            price_cents = ticket["priceCents"]
+
+            invoice_items = stack_items(
+                generate_invoice_items(ticket, invoice_mapping.items),
+                invoice_mapping.sold_seperatly,
+            )
+
+            items_cents = total_cents(invoice_items)
+
+            if items_cents != price_cents:
+                if code not in self.mismatched_codes:
+                    self.mismatched_codes.add(code)
 
-                    logging.info("Saved invoice %s - %s", code, invoice_id)
-                except ValueError:
-                    logging.exception("Inconsistent invoice data")
-                    sys.exit("Will exit to prevent further invoice mistakes")
-                except KeyError as e:
                     logging.error(
-                        "Menu item %s not found on invoicer, please update invoicing.json",
-                        e,
+                        "Items of %s add up to %s instead of ticket price %s, please check invoicing.json",
+                        code,
+                        format_cents(items_cents),
+                        format_cents(price_cents),
                     )
-                except (SystemExit, KeyboardInterrupt):
-                    raise
+
+                return False
+
+            self.mismatched_codes.discard(code)
+
+            invoice = await self.find_issued_invoice(code)
+            invoiced_at = None
+
+            if invoice:
+                logging.warning(
+                    "Found invoice %s already issued for %s", invoice["id"], code
+                )
+            else:
+                nif = find_nif(ticket)
+
+                logging.info("Will invoice %s items %s", code, invoice_items)
+
+                invoice = await self.invoice_delivery(
+                    invoice_items,
+                    code,
+                    platform,
+                    nif,
+                    name,
+                    phone_number,
+                    note,
+                )
+                invoiced_at = datetime.now()
+
+                try:
+                    self.record_document(code, invoice["id"])
                 except Exception:
-                    logging.exception("Invoicer failed")
-    except JSONDecodeError:
-        logging.exception("Unable to decode json. Will retry")
-    except (SystemExit, KeyboardInterrupt):
-        raise
-    except Exception:
-        logging.exception("Unexpected failure. Will retry")
-
-    sleep(1)
+                    logging.exception(
+                        "Failed to journal invoice %s of %s", invoice["id"], code
+                    )
+
+            invoiced_cents = round(float(invoice["amount_gross"]) * 100)
+
+            if invoiced_cents != price_cents:
+                logging.error(
+                    "Invoice %s of %s amounts to %s instead of ticket price %s, please review it on Vendus",
+                    invoice["id"],
+                    code,
+                    format_cents(invoiced_cents),
+                    format_cents(price_cents),
+                )
+
+            invoice_id = invoice["id"]
+            talao = await self.vendus.get_talao(invoice_id)
+            talao_fetched_at = datetime.now()
+
+            logging.info("Invoiced %s - %s", code, invoice_id)
+
+            try:
+                self.save_invoice(
+                    invoice_id,
+                    code,
+                    talao,
+                    invoice,
+                    {
+                        "started_at": start_time,
+                        "seen_at": self.seen_at.get(code),
+                        "invoiced_at": invoiced_at,
+                        "talao_fetched_at": talao_fetched_at,
+                    },
+                    ticket,
+                )
+            except Exception:
+                logging.exception(
+                    "Invoice %s of %s issued but not saved. Will retry",
+                    invoice_id,
+                    code,
+                )
+
+                return False
+
+            logging.info("Saved invoice %s - %s", code, invoice_id)
+
+            return True
+        except ValueError:
+            if code not in self.mismatched_codes:
+                self.mismatched_codes.add(code)
+
+                logging.exception("Inconsistent invoice data of %s", code)
+        except KeyError as e:
+            logging.error(
+                "Menu item %s not found on invoicer, please update invoicing.json",
+                e,
+            )
+        except Exception:
+            logging.exception("Invoicer failed")
+
+        return False
+
+    async def import_manual_invoices_forever(self):
+        while True:
+            imported_count = 0
+            failed = False
+            iteration_started_at = time.perf_counter()
+
+            try:
+                imported_count = await self.import_manual_invoices()
+            except Exception:
+                logging.exception("Failed manual import. Will retry")
+
+                failed = True
+
+            loop_seconds.observe(
+                time.perf_counter() - iteration_started_at,
+                loop=f"manual_import:{self.site.name}",
+            )
+
+            await self.import_scheduler.sleep(imported_count > 0, failed)
+
+    async def invoice_deliveries_forever(self, orders_topic, interval_seconds=1):
+        version = 0
+
+        while True:
+            iteration_started_at = time.perf_counter()
+
+            try:
+                invoice_mapping = self.invoice_mapping_file.get()
+
+                if invoice_mapping is not self.invoice_mapping:
+                    self.invoice_mapping = invoice_mapping
+                    self.mismatched_codes.clear()
+                    self.unmapped_codes.clear()
+
+                if orders_topic.version > version:
+                    version = orders_topic.version
+
+                    logging.debug("New orders snapshot %d", version)
+
+                    self.pending_tickets = {
+                        ticket["code"]: ticket
+                        for ticket in orders_topic.value
+                        if self.is_ticket_invoiceable(ticket)
+                    }
+
+                    seen_at = datetime.now()
+                    self.seen_at = {
+                        code: self.seen_at.get(code, seen_at)
+                        for code in self.pending_tickets
+                    }
+
+                for code, invoicing in list(self.in_flight_tickets.items()):
+                    if invoicing.done():
+                        del self.in_flight_tickets[code]
+
+                        if invoicing.result():
+                            self.pending_tickets.pop(code, None)
+
+                for code, ticket in self.pending_tickets.items():
+                    if code in self.in_flight_tickets:
+                        continue
+
+                    unmapped_skus = invoice_mapping.unmapped_skus(ticket)
+
+                    if unmapped_skus:
+                        if code not in self.unmapped_codes:
+                            self.unmapped_codes.add(code)
+
+                            logging.error(
+                                "Order %s has items missing from invoicing.json %s, run menu.py for suggestions",
+                                code,
+                                unmapped_skus,
+                            )
+                    else:
+                        self.in_flight_tickets[code] = asyncio.create_task(
+                            self.invoice_ticket(ticket, invoice_mapping)
+                        )
+            except (OSError, ValueError):
+                logging.exception("Unable to load invoice mapping. Will retry")
+            except Exception:
+                logging.exception("Unexpected failure. Will retry")
+
+            loop_seconds.observe(
+                time.perf_counter() - iteration_started_at,
+                loop=f"invoicing:{self.site.name}",
+            )
+
+            await orders_topic.wait_newer(version, interval_seconds)
+
+    async def save_issued_invoices(self):
+        cursor = self.invoices.cursor()
+
+        cursor.execute(
+            "select delivery_code from invoice_intent where facility_id = (?)",
+            (self.site.facility_id,),
+        )
+
+        for (code,) in cursor.fetchall():
+            try:
+                invoice = await self.find_issued_invoice(code)
+
+                if not invoice:
+                    logging.info("No invoice was issued for %s", code)
+
+                    self.drop_intent(code)
+                    continue
+
+                talao = await self.vendus.get_talao(invoice["id"])
+
+                self.save_invoice(invoice["id"], code, talao, invoice)
+
+                logging.warning("Saved unsaved invoice %s - %s", code, invoice["id"])
+            except Exception:
+                logging.exception("Failed to reconcile invoice intent of %s", code)
+
+    async def run(self, orders_topic):
+        await self.save_issued_invoices()
+
+        manual_import = asyncio.create_task(self.import_manual_invoices_forever())
+
+        try:
+            await self.invoice_deliveries_forever(orders_topic)
+        finally:
+            manual_import.cancel()
+
+
+def create_invoicer(config, invoices, site, saved_topic):
+    invoicing_concurrency = int(config.get("INVOICING_CONCURRENCY", 4))
+    vendus = AsyncVendusClient(
+        config["VENDUS_API_KEY"], pool_size=invoicing_concurrency
+    )
+
+    import_scheduler = PollScheduler(
+        f"Vendus manual invoices {site.name}",
+        busy_seconds=1,
+        idle_seconds=2,
+        opening_hours=create_opening_hours(config),
+    )
+
+    return Invoicer(
+        vendus,
+        invoices,
+        site,
+        saved_topic,
+        concurrency=invoicing_concurrency,
+        import_scheduler=import_scheduler,
+    )
+
+
+class _FakeVendus:
+    def __init__(self):
+        self.documents = {}
+        self.rejections = []
+        self.lookups = 0
+
+    async def guess_client(self, nif, mobile, name):
+        return {"id": 1}
+
+    async def invoice(self, invoice_items, **invoice_params):
+        if self.rejections:
+            response = requests.Response()
+            response.status_code = self.rejections.pop(0)
+
+            raise requests.HTTPError(response=response)
+
+        document_id = 100 + len(self.documents)
+
+        self.documents[document_id] = {
+            "id": document_id,
+            "number": f"FR {document_id}",
+            "type": "FR",
+            "amount_gross": format_cents(total_cents(invoice_items)),
+            "local_time": "2026-10-18 12:00:00",
+            "external_reference": invoice_params["external_reference"],
+        }
+
+        return dict(self.documents[document_id])
+
+    async def get_invoice_details(self, invoice_id):
+        return dict(self.documents[invoice_id])
+
+    async def get_invoices(
+        self,
+        since=None,
+        register_id=None,
+        external_reference=None,
+        newer_than_id=None,
+    ):
+        self.lookups += 1
+
+        return [
+            dict(document)
+            for document in self.documents.values()
+            if document["external_reference"] == external_reference
+        ]
+
+    async def get_talao(self, invoice_id):
+        return f"TALAO {invoice_id}".encode("ascii")
+
+
+class TestInvoiceJournal(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.invoices = connect(":memory:")
+        self.vendus = _FakeVendus()
+        self.site = Site(
+            {},
+            {"name": "test", "facility_id": "f", "register_id": 1, "payment_id": 1},
+            primary=True,
+        )
+        self.invoice_mapping = InvoiceMapping({"a": "COLA"}, frozenset(), "test")
+
+    def tearDown(self):
+        self.invoices.close()
+
+    def create_invoicer(self):
+        return Invoicer(self.vendus, self.invoices, self.site, Topic())
+
+    def create_ticket(self, code):
+        return {
+            "code": code,
+            "accepted": True,
+            "canceled": False,
+            "customerName": "Ana",
+            "customerPhone": None,
+            "customerNote": None,
+            "platform": "glovo",
+            "startDate": "2026-10-18T12:00:00Z",
+            "priceCents": 250,
+            "items": [
+                {
+                    "skuId": {"id": "a"},
+                    "stationItemDetail": {
+                        "salePrice": {"units": 2, "nanos": 500000000},
+                        "quantity": 1,
+                        "name": "Cola",
+                        "note": None,
+                    },
+                    "itemModifiers": [],
+                }
+            ],
+        }
+
+    def record_intent(self, code, document_id=None):
+        self.invoices.execute(
+            "insert into invoice_intent(facility_id, delivery_code, intended_at, document_id) values ('f', ?, '2026-10-18T12:00:00', ?)",
+            (code, document_id),
+        )
+        self.invoices.commit()
+
+    def saved_invoices(self):
+        return self.invoices.execute(
+            "select id, delivery_code from invoice order by id"
+        ).fetchall()
+
+    def intents(self):
+        return self.invoices.execute(
+            "select delivery_code from invoice_intent order by delivery_code"
+        ).fetchall()
+
+    async def test_retries_failed_save_without_invoicing_again(self):
+        invoicer = self.create_invoicer()
+        ticket = self.create_ticket("A1")
+
+        with mock.patch.object(
+            invoicer, "save_invoice", side_effect=sqlite3.OperationalError("locked")
+        ):
+            with self.assertLogs(level="ERROR"):
+                invoiced = await invoicer.invoice_ticket(ticket, self.invoice_mapping)
+
+        self.assertFalse(invoiced)
+        self.assertEqual(self.intents(), [("A1",)])
+
+        with self.assertLogs(level="WARNING"):
+            invoiced = await invoicer.invoice_ticket(ticket, self.invoice_mapping)
+
+        self.assertTrue(invoiced)
+        self.assertEqual(len(self.vendus.documents), 1)
+        self.assertEqual(self.saved_invoices(), [(100, "A1")])
+        self.assertEqual(self.intents(), [])
+
+    async def test_forgets_intent_when_vendus_rejects_invoice(self):
+        invoicer = self.create_invoicer()
+        ticket = self.create_ticket("A1")
+        self.vendus.rejections = [422, 503]
+
+        with self.assertLogs(level="ERROR"):
+            self.assertFalse(
+                await invoicer.invoice_ticket(ticket, self.invoice_mapping)
+            )
+
+        self.assertEqual(self.intents(), [])
+
+        with self.assertLogs(level="ERROR"):
+            self.assertFalse(
+                await invoicer.invoice_ticket(ticket, self.invoice_mapping)
+            )
+
+        self.assertEqual(self.intents(), [("A1",)])
+        self.assertEqual(self.vendus.lookups, 0)
+
+    async def test_saves_journaled_document_on_restart(self):
+        await self.vendus.invoice([], external_reference="A1")
+        self.record_intent("A1", 100)
+
+        with self.assertLogs(level="WARNING"):
+            await self.create_invoicer().save_issued_invoices()
+
+        self.assertEqual(len(self.vendus.documents), 1)
+        self.assertEqual(self.saved_invoices(), [(100, "A1")])
+        self.assertEqual(self.intents(), [])
+
+    async def test_looks_up_unjournaled_documents_on_restart(self):
+        await self.vendus.invoice([], external_reference="A1")
+        self.record_intent("A1")
+        self.record_intent("B2")
+
+        with self.assertLogs(level="WARNING"):
+            await self.create_invoicer().save_issued_invoices()
+
+        self.assertEqual(len(self.vendus.documents), 1)
+        self.assertEqual(self.saved_invoices(), [(100, "A1")])
+        self.assertEqual(self.intents(), [])
+
+
+async def main():
+    invoices = connect()
+
+    config = dotenv_values(".env")
+    sites = load_sites(config)
+
+    components = []
+
+    for site in sites:
+        orders_topic = Topic()
+        saved_topic = Topic()
+
+        invoicer = create_invoicer(config, invoices, site, saved_topic)
+
+        components += [
+            watch_snapshots({site.orders_path: orders_topic}, 1),
+            signal_wakeups(saved_topic, site.printing_wakeup_path),
+            invoicer.run(orders_topic),
+        ]
+
+    await asyncio.gather(*components)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+    logging.info("Starting invoicing")
+
+    me = single_instance("invoicing")
+
+    asyncio.run(main())
@@ -0,0 +1,150 @@
+import argparse
+import asyncio
+import logging
+from functools import partial
+from dotenv import dotenv_values
+
+import feed
+import invoicing
+import manual_orders
+import metrics
+import orders
+import printing
+from database import connect
+from runtime import Topic, run_components, single_instance
+from sites import load_sites
+from snapshot import publish_snapshots, watch_snapshots
+from vendus import AsyncVendusClient
+from wakeup import FEED_WAKEUP_PATH, signal_wakeups, watch_wakeups
+
+all_components = ("orders", "invoicing", "printing", "manual_orders", "feed")
+
+
+async def main(enabled):
+    config = dotenv_values(".env")
+
+    invoices = connect()
+
+    feed_wakeup_path = None if "feed" in enabled else FEED_WAKEUP_PATH
+    watched_snapshots = {}
+    components = {}
+    feeds = {}
+
+    if "orders" in enabled:
+        client = await asyncio.to_thread(orders.create_client, config)
+
+    if "manual_orders" in enabled:
+        vendus = AsyncVendusClient(config["VENDUS_API_KEY"])
+
+    for site in load_sites(config):
+        orders_topic = Topic()
+        manual_orders_topic = Topic()
+        saved_topic = Topic()
+        events_topics = {}
+
+        if "orders" in enabled:
+            events_topics["orders"] = Topic()
+
+            components[f"orders:{site.name}"] = partial(
+                orders.poll_orders,
+                client,
+                site,
+                orders_topic,
+                orders.create_orders_scheduler(config, site),
+                events_topics["orders"],
+            )
+            components[f"orders_snapshot:{site.name}"] = partial(
+                publish_snapshots, orders_topic, site.orders_path, feed_wakeup_path
+            )
+        elif enabled & {"invoicing", "feed"}:
+            watched_snapshots[site.orders_path] = orders_topic
+
+        if "invoicing" in enabled:
+            invoicer = invoicing.create_invoicer(config, invoices, site, saved_topic)
+
+            components[f"invoicing:{site.name}"] = partial(invoicer.run, orders_topic)
+
+            if "printing" not in enabled:
+                components[f"printing_wakeups:{site.name}"] = partial(
+                    signal_wakeups, saved_topic, site.printing_wakeup_path
+                )
+        elif "printing" in enabled:
+            components[f"printing_wakeups:{site.name}"] = partial(
+                watch_wakeups, site.printing_wakeup_path, saved_topic
+            )
+
+        if "printing" in enabled:
+            components[f"printing:{site.name}"] = partial(
+                printing.print_receipts,
+                invoices,
+                site,
+                printing.create_print_queues(site),
+                saved_topic,
+            )
+
+        if "manual_orders" in enabled:
+            components[f"manual_orders:{site.name}"] = partial(
+                manual_orders.export_manual_orders,
+                invoices,
+                vendus,
+                site,
+                manual_orders_topic,
+                saved_topic,
+            )
+            components[f"manual_orders_snapshot:{site.name}"] = partial(
+                publish_snapshots,
+                manual_orders_topic,
+                site.manual_orders_path,
+                feed_wakeup_path,
+            )
+        elif "feed" in enabled:
+            watched_snapshots[site.manual_orders_path] = manual_orders_topic
+
+        feeds[site.name] = feed.OrdersFeed(
+            {"orders": orders_topic, "manual_orders": manual_orders_topic},
+            events_topics,
+        )
+
+    if "feed" in enabled:
+        host = config.get("FEED_HOST", "0.0.0.0")
+        port = int(config.get("FEED_PORT", 8000))
+
+        components["feed"] = lambda: feed.serve(feeds, host, port)
+
+    if config.get("METRICS_TEXTFILE"):
+        components["metrics"] = lambda: metrics.write_textfile(
+            config["METRICS_TEXTFILE"]
+        )
+
+    if watched_snapshots:
+        snapshots_wakeup_path = FEED_WAKEUP_PATH if "feed" in enabled else None
+
+        components["snapshots"] = lambda: watch_snapshots(
+            watched_snapshots, 1, snapshots_wakeup_path
+        )
+
+    logging.info("Running %s", ", ".join(components))
+
+    await run_components(components)
+
+
+if __name__ == "__main__":
+    config = dotenv_values(".env")
+    default_components = config.get("KITCHEN_COMPONENTS", ",".join(all_components))
+
+    parser = argparse.ArgumentParser(description="Run the kitchen daemons")
+    parser.add_argument(
+        "components",
+        nargs="*",
+        choices=all_components,
+        default=default_components.split(","),
+        help="components to run, defaults to KITCHEN_COMPONENTS or all",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+    enabled = frozenset(args.components)
+    instances = [single_instance(component) for component in sorted(enabled)]
+
+    asyncio.run(main(enabled))
@@ -1,75 +1,152 @@
-from functools import lru_cache
+import asyncio
 import logging
-import sqlite3
-from time import sleep
-from datetime import datetime
-import json
-from tendo import singleton
+from datetime import date, datetime
 from dotenv import dotenv_values
 
-from vendus import VendusClient
+from vendus import AsyncVendusClient
+from snapshot import publish_snapshots
+from database import connect, legacy_import_mark
+from runtime import Topic, single_instance
+from sites import load_sites
+from wakeup import FEED_WAKEUP_PATH
 
 
-invoices = sqlite3.connect("invoices.db")
-
-
-def create_order(invoice):
+def create_order(_id, number, amount_gross, local_time):
     return {
-        "code": str(invoice["id"]),
-        "customerName": invoice["number"] + " " + invoice["amount_gross"],
+        "code": str(_id),
+        "customerName": number + " " + amount_gross,
         "durationMinutes": 10,
         "hideAfterMinutes": 30,
         "expireAfterMinutes": 1,
         "completed": False,
         "accepted": True,
-        "startDate": invoice["local_time"].isoformat(),
+        "startDate": local_time,
     }
 
 
-def write_orders(orders):
-    with open("manual_orders.json", "w") as orders_file:
-        orders_file.write(json.dumps(orders, indent=4))
+async def backfill_invoice_details(invoices, invoicer, site, today_iso):
+    cursor = invoices.cursor()
+    row = cursor.execute(
+        "select document_id from import_mark where name = (?)", (legacy_import_mark,)
+    ).fetchone()
 
+    if not row:
+        return
 
-me = singleton.SingleInstance()
+    (last_legacy_id,) = row
+    legacy_ids = {
+        _id
+        for (_id,) in cursor.execute(
+            "select id from invoice where facility_id = (?) and delivery_code is null and local_time is null and id <= (?)",
+            (site.facility_id, last_legacy_id),
+        )
+    }
 
-logging.basicConfig(format="%(asctime)s %(message)s", level=logging.DEBUG)
+    if not legacy_ids:
+        return
 
-logging.debug("Starting manual order import")
+    backfilled_ids = []
 
+    try:
+        for invoice in await invoicer.get_invoices(
+            since=date.fromisoformat(today_iso), register_id=site.register_id
+        ):
+            if invoice["id"] not in legacy_ids:
+                continue
+
+            cursor.execute(
+                "update invoice set number = (?), amount_gross = (?), local_time = (?), type = (?) where id = (?)",
+                (
+                    invoice["number"],
+                    invoice["amount_gross"],
+                    invoice["local_time"].isoformat(),
+                    invoice["type"],
+                    invoice["id"],
+                ),
+            )
+            backfilled_ids.append(invoice["id"])
+
+        cursor.execute(
+            "delete from import_mark where name = (?)", (legacy_import_mark,)
+        )
+        invoices.commit()
+    except BaseException:
+        invoices.rollback()
 
-config = dotenv_values(".env")
-vendus_api_key = config["VENDUS_API_KEY"]
+        raise
 
-invoicer = VendusClient(vendus_api_key)
+    logging.info(
+        "Backfilled invoice details of today's legacy invoices %s", backfilled_ids
+    )
 
 
-@lru_cache
-def get_invoice_details(_id):
-    return invoicer.get_invoice_details(_id)
+def get_manual_orders(invoices, site, today_iso):
+    cursor = invoices.cursor()
+    rows = cursor.execute(
+        "select id, number, amount_gross, local_time from invoice indexed by invoice_manual_local_time where facility_id = (?) and local_time >= (?) and delivery_code is null and type = 'FR' order by local_time",
+        (site.facility_id, today_iso),
+    )
 
+    return [create_order(*row) for row in rows]
 
-while True:
 
-    try:
-        cursor = invoices.cursor()
-        rows = cursor.execute("select id from invoice where delivery_code is null")
-        orders = []
+async def export_manual_orders(
+    invoices, invoicer, site, manual_orders_topic, saved_topic, interval_seconds=3
+):
+    version = saved_topic.version
 
-        for (_id,) in rows:
-            invoice = get_invoice_details(_id)
+    while True:
 
-            if invoice["type"] == "FR":
-                order = create_order(invoice)
-                orders.append(order)
+        try:
+            today_iso = datetime.today().date().isoformat()
 
-        write_orders(orders)
+            try:
+                await backfill_invoice_details(invoices, invoicer, site, today_iso)
+            except Exception:
+                logging.exception("Failed to backfill invoice details. Will retry")
 
-        logging.debug("Exported %d manual invoices", len(orders))
+            orders = get_manual_orders(invoices, site, today_iso)
 
-    except (SystemExit, KeyboardInterrupt):
-        raise
-    except Exception:
-        logging.exception("Unexpected failure. Will retry")
+            if orders != manual_orders_topic.value:
+                manual_orders_topic.publish(orders)
+
+            logging.debug("Exported %d manual invoices of %s", len(orders), site.name)
+
+        except Exception:
+            logging.exception("Unexpected failure. Will retry")
+
+        await saved_topic.wait_newer(version, interval_seconds)
+        version = saved_topic.version
+
+
+async def main():
+    invoices = connect()
+
+    config = dotenv_values(".env")
+    invoicer = AsyncVendusClient(config["VENDUS_API_KEY"])
+
+    components = []
+
+    for site in load_sites(config):
+        manual_orders_topic = Topic()
+
+        components += [
+            export_manual_orders(
+                invoices, invoicer, site, manual_orders_topic, Topic()
+            ),
+            publish_snapshots(
+                manual_orders_topic, site.manual_orders_path, FEED_WAKEUP_PATH
+            ),
+        ]
+
+    await asyncio.gather(*components)
+
+
+if __name__ == "__main__":
+    me = single_instance("manual_orders")
+
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.DEBUG)
+
+    logging.debug("Starting manual order import")
 
-    sleep(3)
+    asyncio.run(main())
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import unittest
+
+
+class InvoiceMapping:
+    def __init__(self, items, sold_seperatly, content_hash):
+        self.items = items
+        self.sold_seperatly = sold_seperatly
+        self.content_hash = content_hash
+
+        self.ignored = frozenset(
+            sku_id for sku_id, reference in items.items() if reference is None
+        )
+        self.references = frozenset(
+            reference for reference in items.values() if reference is not None
+        )
+
+    def unmapped_skus(self, ticket):
+        unmapped = {}
+
+        for item in ticket["items"]:
+            item_id = item["skuId"]["id"]
+
+            if item_id not in self.items:
+                unmapped[item_id] = item["stationItemDetail"]["name"]
+            elif self.items[item_id] is not None:
+                for modifier in item["itemModifiers"]:
+                    modifier_id = modifier["skuId"]["id"]
+
+                    if modifier_id not in self.items:
+                        unmapped[modifier_id] = modifier["orderItemDetail"]["name"]
+
+        return unmapped
+
+
+def parse_invoice_mapping(content):
+    try:
+        invoice_mapping = json.loads(content)
+        items = invoice_mapping["items"]
+        sold_seperatly = invoice_mapping["sold_seperatly"]
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Malformed invoice mapping: {e!r}")
+
+    if not isinstance(items, dict) or not isinstance(sold_seperatly, list):
+        raise ValueError("Expects items object and sold_seperatly list")
+
+    invalid_references = {
+        sku_id: reference
+        for sku_id, reference in items.items()
+        if reference is not None and not (isinstance(reference, str) and reference)
+    }
+    if invalid_references:
+        raise ValueError(f"Invalid references {invalid_references}")
+
+    references = set(items.values())
+    unknown_sold_seperatly = [
+        reference
+        for reference in sold_seperatly
+        if reference is None or reference not in references
+    ]
+    if unknown_sold_seperatly:
+        raise ValueError(
+            f"Sold separately references missing from items {unknown_sold_seperatly}"
+        )
+
+    return InvoiceMapping(
+        items,
+        frozenset(sold_seperatly),
+        hashlib.sha256(content).hexdigest(),
+    )
+
+
+class InvoiceMappingFile:
+    def __init__(self, file_path="invoicing.json"):
+        self.file_path = file_path
+        self.file_stat = None
+        self.mapping = None
+
+    def get(self):
+        try:
+            stat = os.stat(self.file_path)
+        except OSError:
+            if self.mapping:
+                logging.exception("Unable to stat %s", self.file_path)
+
+                return self.mapping
+
+            raise
+
+        file_stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+        if file_stat == self.file_stat:
+            return self.mapping
+
+        with open(self.file_path, "rb") as mapping_file:
+            content = mapping_file.read()
+
+        self.file_stat = file_stat
+
+        if (
+            self.mapping
+            and hashlib.sha256(content).hexdigest() == self.mapping.content_hash
+        ):
+            return self.mapping
+
+        try:
+            mapping = parse_invoice_mapping(content)
+        except ValueError:
+            if not self.mapping:
+                raise
+
+            logging.exception(
+                "Invalid %s. Keeping previous mapping %s",
+                self.file_path,
+                self.mapping.content_hash[:12],
+            )
+
+            return self.mapping
+
+        logging.info(
+            "Loaded %s %s with %d items, %d ignored",
+            self.file_path,
+            mapping.content_hash[:12],
+            len(mapping.items),
+            len(mapping.ignored),
+        )
+
+        self.mapping = mapping
+
+        return mapping
+
+
+class TestInvoiceMappingFile(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.directory.name, "invoicing.json")
+        self.mapping_file = InvoiceMappingFile(self.file_path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, content, mtime_ns):
+        with open(self.file_path, "w") as mapping_file:
+            mapping_file.write(content)
+
+        os.utime(self.file_path, ns=(mtime_ns, mtime_ns))
+
+    def test_reloads_changed_file(self):
+        self.write('{"items": {"a": "COLA", "b": null}, "sold_seperatly": []}', 1)
+        first_mapping = self.mapping_file.get()
+
+        self.assertIs(self.mapping_file.get(), first_mapping)
+        self.assertEqual(first_mapping.ignored, {"b"})
+
+        self.write(
+            '{"items": {"a": "COLA", "c": "agua-0.5l"}, "sold_seperatly": ["COLA"]}', 2
+        )
+        second_mapping = self.mapping_file.get()
+
+        self.assertEqual(second_mapping.sold_seperatly, {"COLA"})
+        self.assertEqual(second_mapping.items["c"], "agua-0.5l")
+
+    def test_keeps_previous_mapping_on_invalid_edit(self):
+        self.write('{"items": {"a": "COLA"}, "sold_seperatly": []}', 1)
+        good_mapping = self.mapping_file.get()
+
+        for mtime_ns, invalid_content in enumerate(
+            [
+                '{"items": {"a": "COLA"}, "sold_seperatly": ["PEPSI"]}',
+                '{"items": {"a": ""}, "sold_seperatly": []}',
+                '{"items": {"a": "COLA"}, "sold_seperatly": [null]}',
+                '{"items": {"a": "COLA",}',
+            ],
+            start=2,
+        ):
+            self.write(invalid_content, mtime_ns)
+
+            with self.assertLogs(level="ERROR"):
+                self.assertIs(self.mapping_file.get(), good_mapping)
+
+    def test_fails_without_good_mapping(self):
+        self.write('{"items": {"a": "COLA"}, "sold_seperatly": ["PEPSI"]}', 1)
+
+        with self.assertRaises(ValueError):
+            self.mapping_file.get()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,65 +1,217 @@
-import logging
+import argparse
 import json
+import logging
+import sys
+import time
 from pprint import pprint
 from dotenv import dotenv_values
 
+from mapping import InvoiceMappingFile
 from otter import OtterClient
+from snapshot import hash_orders, write_atomically
 
-logging.basicConfig(format="%(asctime)s %(message)s", level=logging.DEBUG)
 logger = logging.getLogger("otter")
 
-config = dotenv_values(".env")
-user = config["OTTER_USER"]
-password = config["OTTER_PASSWORD"]
+menu_id = "47039035-eb87-474b-b0f0-e0e5da5bc6a9"
+
+MENU_SNAPSHOT_PATH = "menu.json"
 
-with open("menu_query.graphql") as query_file:
-    query = query_file.read()
 
-client = OtterClient(logger, user, password)
-client.login()
+def fetch_menu(client, menu_id):
+    with open("menu_query.graphql") as query_file:
+        query = query_file.read()
 
-menu_id = "47039035-eb87-474b-b0f0-e0e5da5bc6a9"
+    menu = client.query("GetTemplateMenu", {"templateId": menu_id}, query)
+
+    id_to_name = {}
 
-operation_name = "GetTemplateMenu"
-variables = {"templateId": menu_id}
+    for entity in menu["data"]["menuTemplate"]["entities"]:
+        try:
+            sku = entity["sku"]
 
-menu = client.query(operation_name, variables, query)
+            id_to_name[sku["id"]] = sku["name"]
+        except KeyError:
+            pass
 
-id_to_name = {}
+    return id_to_name
 
-for entity in menu["data"]["menuTemplate"]["entities"]:
+
+def read_menu_snapshot(file_path=MENU_SNAPSHOT_PATH):
     try:
-        sku = entity["sku"]
+        with open(file_path) as snapshot_file:
+            return json.load(snapshot_file)["skus"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_menu_snapshot(id_to_name, file_path=MENU_SNAPSHOT_PATH):
+    snapshot = {
+        "hash": hash_orders(id_to_name),
+        "fetchedAt": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "skus": id_to_name,
+    }
+
+    write_atomically(file_path, json.dumps(snapshot, indent=4, sort_keys=True))
+
+
+def diff_menus(previous, current):
+    return {
+        "added": {
+            sku_id: name for sku_id, name in current.items() if sku_id not in previous
+        },
+        "removed": {
+            sku_id: name for sku_id, name in previous.items() if sku_id not in current
+        },
+        "renamed": {
+            sku_id: (previous[sku_id], name)
+            for sku_id, name in current.items()
+            if sku_id in previous and previous[sku_id] != name
+        },
+    }
+
+
+def suggest_invoice_items(skus, id_to_name, invoice_item_mapping):
+    name_to_reference = {
+        id_to_name[sku_id]: reference
+        for sku_id, reference in invoice_item_mapping.items()
+        if sku_id in id_to_name and reference
+    }
+
+    return {sku_id: name_to_reference.get(name) for sku_id, name in skus.items()}
+
+
+def report_menu_changes(previous, current, invoice_item_mapping):
+    changes = diff_menus(previous, current)
+
+    if not any(changes.values()):
+        logger.info("Menu unchanged")
+
+        return changes
+
+    for sku_id, name in changes["added"].items():
+        print(f"Added {sku_id} {name}")
+    for sku_id, name in changes["removed"].items():
+        print(f"Removed {sku_id} {name}")
+    for sku_id, (previous_name, name) in changes["renamed"].items():
+        print(f"Renamed {sku_id} {previous_name} -> {name}")
+
+    unmapped = {
+        sku_id: name
+        for sku_id, name in {**changes["added"], **changes["renamed"]}.items()
+        if sku_id not in invoice_item_mapping
+    }
+
+    if unmapped:
+        print("Suggested invoicing.json items")
+        print(
+            json.dumps(
+                suggest_invoice_items(unmapped, current, invoice_item_mapping),
+                indent=4,
+            )
+        )
+
+    return changes
+
+
+def check_menu(id_to_name, invoice_item_mapping):
+    print("All items")
+    pprint(id_to_name)
+
+    in_invoicing = {
+        id_existing: {invoice_match: id_to_name.get(id_existing)}
+        for id_existing, invoice_match in invoice_item_mapping.items()
+    }
+    print("Matched items")
+    pprint(in_invoicing)
+
+    missing_from_invoicing = {
+        id_missing: name
+        for id_missing, name in id_to_name.items()
+        if id_missing not in invoice_item_mapping
+    }
+
+    if missing_from_invoicing:
+        print("Missing items")
+        pprint(missing_from_invoicing)
+
+        print("Suggested invoicing.json items")
+        print(
+            json.dumps(
+                suggest_invoice_items(
+                    missing_from_invoicing, id_to_name, invoice_item_mapping
+                ),
+                indent=4,
+            )
+        )
+
+        print("Not all menu items are invoiceable")
+
+        return False
 
-        id_to_name[sku["id"]] = sku["name"]
-    except KeyError:
-        pass
+    print("Every item is invoiceable")
 
-print("All items")
-pprint(id_to_name)
+    return True
 
-with open("invoicing.json") as invoice_mapping_file:
-    invoice_mapping = json.load(invoice_mapping_file)
 
-invoice_item_mapping = invoice_mapping["items"]
-ids_missing_from_invoicing = set(id_to_name) - set(invoice_item_mapping)
+def watch_menu(client, invoice_mapping_file, interval_seconds):
+    previous = read_menu_snapshot() or {}
 
-in_invoicing = {
-    id_existing: {invoice_match: id_to_name.get(id_existing)}
-    for id_existing, invoice_match in invoice_item_mapping.items()
-}
-print("Matched items")
-pprint(in_invoicing)
+    while True:
+        try:
+            current = fetch_menu(client, menu_id)
 
-missing_from_invoicing = {
-    id_missing: id_to_name[id_missing] for id_missing in ids_missing_from_invoicing
-}
+            report_menu_changes(previous, current, invoice_mapping_file.get().items)
 
-if missing_from_invoicing:
-    print("Missing items")
-    pprint(missing_from_invoicing)
+            if current != previous:
+                write_menu_snapshot(current)
 
-    print("Not all menu items are invoiceable")
-    exit(code=1)
-else:
-    print("Every item is invoiceable")
+                previous = current
+        except Exception:
+            logger.exception("Failed to check menu. Will retry")
+
+        time.sleep(interval_seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check Otter menu against invoicing.json"
+    )
+    parser.add_argument(
+        "--cached",
+        action="store_true",
+        help="check the stored menu snapshot without fetching it",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep fetching the menu and report added, removed or renamed items",
+    )
+    parser.add_argument("--interval", type=float, default=600)
+    args = parser.parse_args()
+
+    config = dotenv_values(".env")
+    client = OtterClient(logger, config["OTTER_USER"], config["OTTER_PASSWORD"])
+    invoice_mapping_file = InvoiceMappingFile()
+
+    if args.watch:
+        watch_menu(client, invoice_mapping_file, args.interval)
+
+    id_to_name = read_menu_snapshot() if args.cached else None
+
+    if id_to_name is None:
+        id_to_name = fetch_menu(client, menu_id)
+
+        previous = read_menu_snapshot()
+        if previous is not None:
+            report_menu_changes(previous, id_to_name, invoice_mapping_file.get().items)
+
+        write_menu_snapshot(id_to_name)
+
+    if not check_menu(id_to_name, invoice_mapping_file.get().items):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.DEBUG)
+
+    main()
@@ -0,0 +1,326 @@
+import asyncio
+import bisect
+import logging
+import threading
+import time
+import unittest
+
+from snapshot import write_atomically
+
+default_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+
+    return "{" + pairs + "}"
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+
+    return repr(float(value))
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+        return metric
+
+    def render(self):
+        lines = []
+
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, label_names=(), registry=registry):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple((name, labels[name]) for name in self.label_names)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+
+        return [
+            f"{self.name}{_format_labels(key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._functions = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function, **labels):
+        self._functions[self._key(labels)] = function
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+
+        for key, function in self._functions.items():
+            value = function()
+
+            if value is not None:
+                values[key] = value
+
+        return [
+            f"{self.name}{_format_labels(key)} {_format_value(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets=default_buckets, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            counts, total, observations = self._values.get(
+                key, ([0] * len(self.buckets), 0, 0)
+            )
+
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(counts):
+                counts[index] += 1
+
+            self._values[key] = (counts, total + value, observations + 1)
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        lines = []
+
+        with self._lock:
+            values = sorted(
+                (key, list(counts), total, observations)
+                for key, (counts, total, observations) in self._values.items()
+            )
+
+        for key, counts, total, observations in values:
+            cumulative = 0
+
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket_labels = key + (("le", _format_value(bucket)),)
+
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(bucket_labels)} {cumulative}"
+                )
+
+            lines.append(
+                f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {observations}"
+            )
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {observations}")
+
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started_at, **self.labels)
+
+
+stage_seconds = Histogram(
+    "kitchen_stage_seconds",
+    "Seconds an order spent reaching each stage from the previous one",
+    ["stage"],
+)
+api_requests = Counter(
+    "kitchen_api_requests_total",
+    "Requests made to Otter and Vendus",
+    ["service", "operation", "outcome"],
+)
+api_request_seconds = Histogram(
+    "kitchen_api_request_seconds",
+    "Duration of requests made to Otter and Vendus",
+    ["service", "operation"],
+)
+loop_seconds = Histogram(
+    "kitchen_loop_seconds",
+    "Duration of each component loop iteration",
+    ["loop"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30),
+)
+orders_staleness_seconds = Gauge(
+    "kitchen_orders_staleness_seconds",
+    "Seconds since orders were last fetched from Otter",
+    ["site"],
+)
+
+
+stages = (
+    "started_at",
+    "seen_at",
+    "invoiced_at",
+    "talao_fetched_at",
+    "saved_at",
+    "printed_at",
+)
+
+
+def observe_stages(timestamps):
+    for previous, stage in zip(stages, stages[1:]):
+        if timestamps.get(previous) and timestamps.get(stage):
+            stage_seconds.observe(
+                (timestamps[stage] - timestamps[previous]).total_seconds(),
+                stage=stage.removesuffix("_at"),
+            )
+
+    if timestamps.get("started_at") and timestamps.get("printed_at"):
+        stage_seconds.observe(
+            (timestamps["printed_at"] - timestamps["started_at"]).total_seconds(),
+            stage="total",
+        )
+
+
+def track_api_request(service, operation, call):
+    outcome = "error"
+
+    try:
+        with api_request_seconds.time(service=service, operation=operation):
+            result = call()
+
+        outcome = str(getattr(result, "status_code", "ok"))
+
+        return result
+    finally:
+        api_requests.inc(service=service, operation=operation, outcome=outcome)
+
+
+async def track_async_api_request(service, operation, call):
+    outcome = "error"
+
+    try:
+        with api_request_seconds.time(service=service, operation=operation):
+            result = await call()
+
+        outcome = "ok"
+
+        return result
+    finally:
+        api_requests.inc(service=service, operation=operation, outcome=outcome)
+
+
+async def write_textfile(file_path, interval_seconds=15):
+    while True:
+        try:
+            write_atomically(file_path, registry.render())
+        except OSError:
+            logging.exception("Unable to write metrics to %s", file_path)
+
+        await asyncio.sleep(interval_seconds)
+
+
+class TestRegistry(unittest.TestCase):
+    def test_render(self):
+        test_registry = Registry()
+
+        requests = Counter(
+            "requests_total", "Requests", ["service"], registry=test_registry
+        )
+        latency = Histogram(
+            "latency_seconds", "Latency", buckets=(0.5, 1), registry=test_registry
+        )
+        age = Gauge("age_seconds", "Age", registry=test_registry)
+
+        requests.inc(service="vendus")
+        requests.inc(2, service="vendus")
+        latency.observe(0.25)
+        latency.observe(0.75)
+        latency.observe(3)
+        age.set_function(lambda: 1.5)
+
+        self.assertEqual(
+            test_registry.render(),
+            "\n".join(
+                [
+                    "# HELP requests_total Requests",
+                    "# TYPE requests_total counter",
+                    'requests_total{service="vendus"} 3',
+                    "# HELP latency_seconds Latency",
+                    "# TYPE latency_seconds histogram",
+                    'latency_seconds_bucket{le="0.5"} 1',
+                    'latency_seconds_bucket{le="1"} 2',
+                    'latency_seconds_bucket{le="+Inf"} 3',
+                    "latency_seconds_sum 4",
+                    "latency_seconds_count 3",
+                    "# HELP age_seconds Age",
+                    "# TYPE age_seconds gauge",
+                    "age_seconds 1.5",
+                ]
+            )
+            + "\n",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,42 +1,177 @@
+import argparse
+import fileinput
 import re
+import string
+import unittest
+from dataclasses import dataclass
+
+_weights = (9, 8, 7, 6, 5, 4, 3, 2)
+_control_digits = tuple(
+    0 if remainder < 2 else 11 - remainder for remainder in range(11)
+)
+_first_digits = frozenset("125689")
+_mobile_prefixes = frozenset({"91", "92", "93", "96"})
+
+_labelled_confidence = 0.9
+_contiguous_confidence = 0.6
+_separated_confidence = 0.5
+_phone_confidence = 0.2
+
+_candidate_pattern = re.compile(
+    r"(?:(?P<label>\b(?:nif|nipc|contribuinte|contrib|pt)[\s:.#nº°-]*)"
+    r"|(?P<phone>\+|\b00|\b(?:tel|tlm|telefone|telem[oó]vel|phone|contacto)[\s:.-]*))?"
+    r"(?<!\d)(?P<digits>\d(?:[ .-]?\d)*)",
+    re.IGNORECASE,
+)
+_group_pattern = re.compile(r"\d+")
+_without_digits = str.maketrans("", "", string.digits)
+
+
+@dataclass(frozen=True)
+class NifCandidate:
+    nif: str
+    start: int
+    end: int
+    confidence: float
 
 
-def _convert_to_int_list(nif_str):
-    return list(map(int, nif_str))
+def check(nif_str):
+    if len(nif_str) != 9 or not nif_str.isdigit() or nif_str[0] not in _first_digits:
+        return False
 
+    weighted_sum = sum(weight * int(digit) for weight, digit in zip(_weights, nif_str))
 
-def _check_len(nif):
-    return len(nif) == 9
+    return _control_digits[weighted_sum % 11] == int(nif_str[-1])
 
 
-def _check_type(nif):
-    return nif[0] in {1, 2, 5, 6, 8, 9}
+def _confidence(match, nif, separated):
+    if match["label"]:
+        return _labelled_confidence
 
+    if match["phone"] or nif[:2] in _mobile_prefixes:
+        return _phone_confidence
 
-def _check_control(nif):
-    sum_ = 0
-    for pos, dig in enumerate(nif[:-1]):
-        sum_ += dig * (9 - pos)
+    return _separated_confidence if separated else _contiguous_confidence
 
-    control = sum_ % 11 and (11 - sum_ % 11) % 10
 
-    return control == nif[-1]
+def extract(text):
+    candidates = []
 
+    for match in _candidate_pattern.finditer(text):
+        digits_start = match.start("digits")
+        groups = list(_group_pattern.finditer(match["digits"]))
 
-def check(nif_str):
-    try:
-        nif = _convert_to_int_list(nif_str)
+        for first, group in enumerate(groups):
+            length = 0
+
+            for last in range(first, len(groups)):
+                length += len(groups[last][0])
+
+                if length >= 9:
+                    break
+
+            if length != 9:
+                continue
+
+            nif = "".join(window[0] for window in groups[first : last + 1])
+
+            if check(nif):
+                candidates.append(
+                    NifCandidate(
+                        nif,
+                        digits_start + group.start(),
+                        digits_start + groups[last].end(),
+                        _confidence(match, nif, last > first),
+                    )
+                )
+
+    return candidates
+
+
+def search(text, min_confidence=_separated_confidence):
+    candidates = sorted(
+        (
+            candidate
+            for candidate in extract(text)
+            if candidate.confidence >= min_confidence
+        ),
+        key=lambda candidate: (-candidate.confidence, candidate.start),
+    )
+
+    return list(dict.fromkeys(candidate.nif for candidate in candidates))
+
+
+def extract_all(texts):
+    extracted = {}
+    results = []
+
+    for text in texts:
+        text = text or ""
+
+        if len(text) - len(text.translate(_without_digits)) < 9:
+            results.append([])
+            continue
+
+        if text not in extracted:
+            extracted[text] = extract(text)
+
+        results.append(extracted[text])
+
+    return results
+
+
+class TestExtract(unittest.TestCase):
+    def test_normalizes_common_formats(self):
+        for note in [
+            "NIF 123456789",
+            "NIF:123.456.789",
+            "PT 123 456 789",
+            "pt123456789 por favor",
+            "contribuinte nº 123-456-789",
+        ]:
+            with self.subTest(note=note):
+                (candidate,) = extract(note)
+
+                self.assertEqual(candidate.nif, "123456789")
+                self.assertEqual(candidate.confidence, _labelled_confidence)
+                self.assertEqual(
+                    note[candidate.start : candidate.end].translate(
+                        str.maketrans("", "", " .-")
+                    ),
+                    "123456789",
+                )
+
+    def test_prefers_labelled_nif_over_phone_numbers(self):
+        note = "tlm 912 345 608, sem cebola 123456789 (nif 501442600)"
+
+        self.assertEqual(search(note), ["501442600", "123456789"])
+        self.assertEqual(search("912345616"), [])
+        self.assertEqual(search("123456780"), [])
+
+    def test_extracts_many_notes(self):
+        notes = ["NIF 123456789", None, "sem picante", "NIF 123456789"]
+
+        self.assertEqual(
+            [[candidate.nif for candidate in found] for found in extract_all(notes)],
+            [["123456789"], [], [], ["123456789"]],
+        )
 
-        return _check_len(nif) and _check_type(nif) and _check_control(nif)
-    except (ValueError, IndexError):
-        return False
 
+def main():
+    parser = argparse.ArgumentParser(
+        description="List the NIFs found in each line of customer notes"
+    )
+    parser.add_argument("files", nargs="*", help="files with one note per line")
+    parser.add_argument("--min-confidence", type=float, default=_separated_confidence)
+    args = parser.parse_args()
 
-_nine_digits_numbers_pattern = re.compile(r"[0-9\(\)]+")
+    lines = [line.rstrip("\n") for line in fileinput.input(args.files)]
 
+    for line_number, candidates in enumerate(extract_all(lines), start=1):
+        for candidate in candidates:
+            if candidate.confidence >= args.min_confidence:
+                print(f"{line_number}\t{candidate.nif}\t{candidate.confidence}")
 
-def search(text):
-    nine_digits_numbers = _nine_digits_numbers_pattern.findall(text)
-    valid_nifs = filter(check, nine_digits_numbers)
 
-    return list(valid_nifs)
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,16 @@
+import asyncio
 import logging
 import math
-from time import sleep
-import json
+import time
 from dotenv import dotenv_values
 
-from otter import OtterClient, convert_google_money
+from metrics import loop_seconds, orders_staleness_seconds
+from otter import OtterClient, google_money_cents
+from runtime import Topic, single_instance
+from scheduler import PollScheduler, create_opening_hours
+from sites import load_sites
+from snapshot import publish_snapshots
+from wakeup import FEED_WAKEUP_PATH
 
 
 def create_order_ticket(order):
@@ -17,7 +23,9 @@ def create_order_ticket(order):
     custumer_name = custumer_order["customer"]["displayName"]
     custumer_note = custumer_order["customerNote"]
     customer_payment = custumer_order["customerPayment"]["total"]
-    price = convert_google_money(customer_payment["units"], customer_payment["nanos"])
+    price_cents = google_money_cents(
+        customer_payment["units"], customer_payment["nanos"]
+    )
 
     if ofo not in {"ubereats", "ubereats-api"}:
         custumer_phone_number = custumer_order["customer"]["phone"]
@@ -70,12 +78,13 @@ def create_order_ticket(order):
     return {
         "courierName": courier_name,
         "platform": ofo,
+        "station": station_order.get("stationId"),
         "code": code,
         "customerName": custumer_name,
         "customerPhone": custumer_phone_number,
         "customerNote": custumer_note,
         "customerPreviousOrders": customer_previous_orders,
-        "price": price,
+        "priceCents": price_cents,
         "items": customer_items,
         "startDate": accepted_date,
         "completed": is_completed,
@@ -87,43 +96,136 @@ def create_order_ticket(order):
     }
 
 
-def update_orders_file(file_path, refreshed_orders):
-    with open(file_path, "w") as orders_file:
-        orders_file.write(json.dumps(refreshed_orders, indent=4))
+logger = logging.getLogger("otter")
 
 
-def get_order_tickets(client, facility_id):
-    orders = client.get_orders(facility_id)["orders"]
-    order_tickets = list(map(create_order_ticket, orders))
+class OrderTickets:
+    def __init__(self):
+        self.orders = {}
+        self.tickets = []
 
-    return order_tickets
+    def update(self, orders):
+        current_orders = {}
+        added = []
+        changed = []
 
+        for order in orders:
+            code = order["customerOrder"]["externalOrderId"]["displayId"]
+            previous = self.orders.get(code)
 
-logging.basicConfig(format="%(asctime)s %(message)s", level=logging.DEBUG)
-logger = logging.getLogger("otter")
+            if previous and previous[0] == order:
+                current_orders[code] = previous
+                continue
 
-config = dotenv_values(".env")
-user = config["OTTER_USER"]
-password = config["OTTER_PASSWORD"]
+            ticket = create_order_ticket(order)
+            current_orders[code] = (order, ticket)
 
-logger.debug("Starting updating orders")
+            if previous:
+                changed.append(ticket)
+            else:
+                added.append(ticket)
 
-client = OtterClient(logger, user, password)
-client.login()
+        removed = [code for code in self.orders if code not in current_orders]
 
-facility_id = "ec411c9b-34b2-391d-9d61-fbc9ef40fc8c"
+        self.orders = current_orders
+        self.tickets = [ticket for _, ticket in current_orders.values()]
 
-while True:
-    try:
-        order_tickets = get_order_tickets(client, facility_id)
-        update_orders_file("orders.json", order_tickets)
+        return {"added": added, "changed": changed, "removed": removed}
+
+
+def has_open_orders(tickets):
+    return any(not ticket["completed"] for ticket in tickets)
+
+
+def create_orders_scheduler(config, site):
+    return PollScheduler(
+        f"Otter orders {site.name}",
+        busy_seconds=2,
+        idle_seconds=3,
+        opening_hours=create_opening_hours(config),
+    )
+
+
+async def poll_orders(client, site, orders_topic, scheduler, events_topic=None):
+    order_tickets = OrderTickets()
+    fetched_at = None
+
+    def staleness():
+        return time.monotonic() - fetched_at if fetched_at else None
+
+    orders_staleness_seconds.set_function(staleness, site=site.name)
+
+    while True:
+        failed = False
+        iteration_started_at = time.perf_counter()
+
+        try:
+            orders = await asyncio.to_thread(client.get_orders, site.facility_id)
+            fetched_at = time.monotonic()
+
+            events = order_tickets.update(orders["orders"])
+
+            if (
+                events["added"]
+                or events["changed"]
+                or events["removed"]
+                or not orders_topic.version
+            ):
+                orders_topic.publish(order_tickets.tickets)
+
+                if events_topic:
+                    events_topic.publish({"sequence": orders_topic.version, **events})
+
+                logger.debug(
+                    "Orders of %s updated to %d: %d added, %d changed, %d removed",
+                    site.name,
+                    orders_topic.version,
+                    len(events["added"]),
+                    len(events["changed"]),
+                    len(events["removed"]),
+                )
+            else:
+                logger.debug("Orders of %s unchanged", site.name)
+        except Exception:
+            logger.exception("Failed to update orders of %s. Will retry", site.name)
+
+            failed = True
+
+        loop_seconds.observe(
+            time.perf_counter() - iteration_started_at, loop=f"orders:{site.name}"
+        )
+
+        await scheduler.sleep(has_open_orders(order_tickets.tickets), failed)
+
+
+def create_client(config):
+    return OtterClient(logger, config["OTTER_USER"], config["OTTER_PASSWORD"])
+
+
+async def main():
+    config = dotenv_values(".env")
+    client = create_client(config)
+
+    components = []
+
+    for site in load_sites(config):
+        orders_topic = Topic()
+
+        components += [
+            poll_orders(
+                client, site, orders_topic, create_orders_scheduler(config, site)
+            ),
+            publish_snapshots(orders_topic, site.orders_path, FEED_WAKEUP_PATH),
+        ]
+
+    await asyncio.gather(*components)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.DEBUG)
 
-        logger.debug("Orders updated")
-    except (SystemExit, KeyboardInterrupt):
-        raise
-    except Exception:
-        logger.exception("Failed to update orders. Will retry")
+    me = single_instance("orders")
 
-        client.login()
+    logger.debug("Starting updating orders")
 
-    sleep(3)
+    asyncio.run(main())
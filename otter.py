@@ -1,32 +1,153 @@
+import base64
+import fcntl
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
 import requests
 from requests.adapters import HTTPAdapter, Retry
 
+from metrics import track_api_request
+from snapshot import write_atomically
+
+
+def google_money_cents(units, nanos):
+    return units * 100 + round(nanos / 10**7)
+
+
+def _token_expiry(access_token):
+    try:
+        payload = access_token.split(".")[1]
+        claims = json.loads(
+            base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+        )
 
-def convert_google_money(units, nanos):
-    return round(units + nanos * 10 ** (-9), 2)
+        return float(claims["exp"])
+    except (IndexError, ValueError, KeyError, TypeError):
+        return None
 
 
-class RefreshTokenStrategy:
-    def __init__(self, logger, client):
+class TokenManager:
+    def __init__(
+        self,
+        logger,
+        session,
+        login_url,
+        email,
+        password,
+        cache_path=".otter_session.json",
+        refresh_margin_seconds=300,
+    ):
         self.logger = logger
-        self.client = client
+        self.session = session
+        self.login_url = login_url
+        self.email = email
+        self.password = password
+        self.cache_path = cache_path
+        self.refresh_margin_seconds = refresh_margin_seconds
+
+        self.access_token = None
+        self.expires_at = None
+
+        self._lock = threading.Lock()
 
-    def refresh():
-        self.logger.debug("Refreshing token")
+    def _is_fresh(self):
+        if not self.access_token:
+            return False
+
+        if self.expires_at is None:
+            return True
+
+        return time.time() < self.expires_at - self.refresh_margin_seconds
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path) as cache_file:
+                session = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+
+        if session.get("email") == self.email and session.get("accessToken"):
+            self.access_token = session["accessToken"]
+            self.expires_at = session.get("expiresAt")
+
+    def _save_cache(self):
+        session = {
+            "email": self.email,
+            "accessToken": self.access_token,
+            "expiresAt": self.expires_at,
+        }
+
+        write_atomically(self.cache_path, json.dumps(session), mode=0o600)
+
+    def _sign_in(self):
+        credentials = {"email": self.email, "password": self.password}
+
+        response = track_api_request(
+            "otter",
+            "sign_in",
+            lambda: self.session.post(self.login_url, json=credentials),
+        )
+        response.raise_for_status()
 
-        self.client.login()
+        self.access_token = response.json()["accessToken"]
+        self.expires_at = _token_expiry(self.access_token)
+
+        self._save_cache()
+
+        self.logger.debug("Logged in")
+
+    def _refresh(self, stale_token):
+        with self._lock, open(f"{self.cache_path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            if self.access_token == stale_token:
+                self._load_cache()
+
+            if self.access_token == stale_token or not self._is_fresh():
+                self.logger.debug("Refreshing token")
+
+                self._sign_in()
+
+            return self.access_token
+
+    def get(self):
+        if not self.access_token:
+            self._load_cache()
+
+        access_token = self.access_token
+
+        if self._is_fresh():
+            return access_token
+
+        return self._refresh(access_token)
+
+    def refresh(self, stale_token):
+        return self._refresh(stale_token)
 
 
 class OtterClient:
-    def __init__(self, logger, email, password):
+    def __init__(
+        self,
+        logger,
+        email,
+        password,
+        base_url="https://api.tryotter.com",
+        session_cache_path=".otter_session.json",
+    ):
         self.logger = logger
         self.email = email
         self.password = password
 
-        self.login_url = "https://api.tryotter.com/users/sign_in"
-        self.orders_url = "https://api.tryotter.com/ufo/otter_order_active"
-        self.orders_history_url = "https://api.tryotter.com/ufo/otter_order_history"
-        self.graphql_url = "https://api.tryotter.com/graphql"
+        self.login_url = f"{base_url}/users/sign_in"
+        self.orders_url = f"{base_url}/ufo/otter_order_active"
+        self.orders_history_url = f"{base_url}/ufo/otter_order_history"
+        self.graphql_url = f"{base_url}/graphql"
 
         self.version = "dd939fbb7062766a7fae374d26620c47b47b6708"
 
@@ -36,58 +157,168 @@ class OtterClient:
             status_forcelist=frozenset({500, 502, 503, 504}),
         )
         self.session = requests.Session()
-        self.session.mount(
-            "https://api.tryotter.com", HTTPAdapter(max_retries=self.retry_config)
-        )
+        self.session.mount(base_url, HTTPAdapter(max_retries=self.retry_config))
         self.session.headers.update(
             {"application-version": self.version, "accept": "application/json"}
         )
 
-        self.refresh_token_strategy = RefreshTokenStrategy(logger, self)
-        self.access_token = None
-
-    def _ensure_logged_in(self):
-        if not self.access_token:
-            raise ValueError("Not logged in")
+        self.tokens = TokenManager(
+            logger,
+            self.session,
+            self.login_url,
+            email,
+            password,
+            cache_path=session_cache_path,
+        )
 
     def login(self):
-        credentials = {"email": self.email, "password": self.password}
+        self.tokens.refresh(self.tokens.access_token)
 
-        response = self.session.post(self.login_url, json=credentials)
-        response.raise_for_status()
+    def _request(self, operation, method, url, **kwargs):
+        access_token = self.tokens.get()
 
-        user_resource = response.json()
+        def send():
+            headers = {"authorization": f"Bearer {access_token}"}
 
-        self.access_token = user_resource["accessToken"]
-        self.session.headers.update({"authorization": f"Bearer {self.access_token}"})
+            return track_api_request(
+                "otter",
+                operation,
+                lambda: self.session.request(method, url, headers=headers, **kwargs),
+            )
 
-        self.logger.debug("Logged in")
+        response = send()
 
-    def get_orders(self, facility_id, limit=75):
-        self._ensure_logged_in()
+        if response.status_code in {401, 403}:
+            access_token = self.tokens.refresh(access_token)
+
+            response = send()
+
+        response.raise_for_status()
+
+        return response.json()
 
+    def get_orders(self, facility_id, limit=75):
         params = {"facility_id": facility_id, "limit": limit}
 
-        def request_orders():
-            return self.session.get(self.orders_url, params=params)
+        return self._request("orders", "GET", self.orders_url, params=params)
 
-        response = request_orders()
+    def query(self, operation_name, variables, query):
+        data = {"operationName": operation_name, "variables": variables, "query": query}
 
-        if response.status_code == 403:
-            self.refresh_token_strategy.refresh()
+        return self._request(operation_name, "POST", self.graphql_url, json=data)
 
-            response = request_orders()
 
-        response.raise_for_status()
+def _fake_token(name, expires_at):
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": expires_at}).encode())
 
-        return response.json()
+    return f"header.{payload.decode().rstrip('=')}.{name}"
 
-    def query(self, operation_name, variables, query):
-        self._ensure_logged_in()
 
-        data = {"operationName": operation_name, "variables": variables, "query": query}
+def _fake_response(status_code, body):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(body).encode()
 
-        response = self.session.post(self.graphql_url, json=data)
-        response.raise_for_status()
+    return response
 
-        return response.json()
+
+class _FakeOtterSession:
+    def __init__(self, accepted_tokens, new_token):
+        self.accepted_tokens = accepted_tokens
+        self.new_token = new_token
+
+        self.sign_ins = 0
+        self.authorizations = []
+
+    def post(self, url, json):
+        self.sign_ins += 1
+        self.accepted_tokens.add(self.new_token)
+
+        return _fake_response(200, {"accessToken": self.new_token})
+
+    def request(self, method, url, headers, **kwargs):
+        access_token = headers["authorization"].removeprefix("Bearer ")
+        self.authorizations.append(access_token)
+
+        if access_token not in self.accepted_tokens:
+            return _fake_response(401, {})
+
+        return _fake_response(200, {"orders": []})
+
+
+class TestTokenManager(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.directory.name, "otter_session.json")
+
+        expires_at = time.time() + 3600
+        self.cached_token = _fake_token("cached", expires_at)
+        self.other_token = _fake_token("other", expires_at)
+        self.new_token = _fake_token("new", expires_at)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def cache_token(self, access_token):
+        with open(self.cache_path, "w") as cache_file:
+            json.dump(
+                {
+                    "email": "kitchen@example.com",
+                    "accessToken": access_token,
+                    "expiresAt": _token_expiry(access_token),
+                },
+                cache_file,
+            )
+
+    def create_client(self, accepted_tokens):
+        client = OtterClient(
+            logging.getLogger("otter"),
+            "kitchen@example.com",
+            "secret",
+            session_cache_path=self.cache_path,
+        )
+        client.session = client.tokens.session = _FakeOtterSession(
+            accepted_tokens, self.new_token
+        )
+
+        return client
+
+    def test_reuses_cached_token(self):
+        self.cache_token(self.cached_token)
+        client = self.create_client({self.cached_token})
+
+        client.get_orders("f")
+        client.get_orders("f")
+
+        self.assertEqual(client.session.sign_ins, 0)
+        self.assertEqual(client.session.authorizations, [self.cached_token] * 2)
+
+    def test_signs_in_once_when_token_is_rejected(self):
+        self.cache_token(self.cached_token)
+        client = self.create_client(set())
+
+        self.assertEqual(client.get_orders("f"), {"orders": []})
+
+        self.assertEqual(client.session.sign_ins, 1)
+        self.assertEqual(
+            client.session.authorizations, [self.cached_token, self.new_token]
+        )
+
+        with open(self.cache_path) as cache_file:
+            self.assertEqual(json.load(cache_file)["accessToken"], self.new_token)
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.cache_path).st_mode), 0o600)
+
+    def test_reuses_token_refreshed_by_another_process(self):
+        self.cache_token(self.cached_token)
+        client = self.create_client({self.other_token})
+        client.tokens.get()
+
+        self.cache_token(self.other_token)
+
+        self.assertEqual(client.get_orders("f"), {"orders": []})
+
+        self.assertEqual(client.session.sign_ins, 0)
+        self.assertEqual(
+            client.session.authorizations, [self.cached_token, self.other_token]
+        )
@@ -0,0 +1,534 @@
+import http.server
+import re
+import select
+import socket
+import struct
+import subprocess
+import threading
+import time
+import unittest
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+
+
+def extract_print_id(print_output):
+    m = re.search(r"request id is\s(.+?)\s\(", print_output)
+
+    if m:
+        return m.group(1)
+    else:
+        return None
+
+
+class LpPrinter:
+    def __init__(self, destination=None, timeout=5, cups_host="localhost"):
+        self.destination = destination
+        self.timeout = timeout
+        self.cups_host = cups_host
+        self.ipp_printers = {}
+
+    def print(self, data):
+        command = ["lp"]
+
+        if self.destination:
+            command += ["-d", self.destination]
+
+        completed_process = subprocess.run(
+            command, capture_output=True, input=data, timeout=self.timeout
+        )
+        completed_process.check_returncode()
+
+        output_str = completed_process.stdout.decode("utf-8")
+
+        print_id = extract_print_id(output_str)
+        if not print_id:
+            raise ValueError(f"Unable to extract print_id from {output_str}")
+
+        return print_id
+
+    def _ipp_job(self, print_id):
+        destination, job_id = print_id.rsplit("-", maxsplit=1)
+
+        if destination not in self.ipp_printers:
+            self.ipp_printers[destination] = IppPrinter(
+                f"ipp://{self.cups_host}/printers/{destination}",
+                timeout=(3.05, self.timeout),
+            )
+
+        return self.ipp_printers[destination], f"ipp-{job_id}"
+
+    def job_state(self, print_id):
+        ipp_printer, ipp_print_id = self._ipp_job(print_id)
+
+        return ipp_printer.job_state(ipp_print_id)
+
+    def cancel_job(self, print_id):
+        ipp_printer, ipp_print_id = self._ipp_job(print_id)
+
+        ipp_printer.cancel_job(ipp_print_id)
+
+    def close(self):
+        for ipp_printer in self.ipp_printers.values():
+            ipp_printer.close()
+
+        self.ipp_printers.clear()
+
+
+class RawPrinter:
+    def __init__(self, host, port=9100, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+        self.connection = None
+
+    def _is_connection_alive(self):
+        readable, _, _ = select.select([self.connection], [], [], 0)
+
+        if not readable:
+            return True
+
+        try:
+            status_bytes = self.connection.recv(4096)
+        except OSError:
+            return False
+
+        return status_bytes != b""
+
+    def _ensure_connected(self):
+        if self.connection and not self._is_connection_alive():
+            self.close()
+
+        if not self.connection:
+            self.connection = socket.create_connection(
+                (self.host, self.port), timeout=self.timeout
+            )
+
+    def print(self, data):
+        self._ensure_connected()
+
+        try:
+            self.connection.sendall(data)
+        except OSError:
+            self.close()
+
+            raise
+
+        return f"raw-{time.time_ns()}"
+
+    def job_state(self, print_id):
+        return "completed"
+
+    def cancel_job(self, print_id):
+        pass
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+
+_IPP_PRINT_JOB = 0x0002
+_IPP_CANCEL_JOB = 0x0008
+_IPP_GET_JOB_ATTRIBUTES = 0x0009
+_IPP_NOT_FOUND = 0x0406
+_IPP_OPERATION_ATTRIBUTES_TAG = 0x01
+_IPP_END_OF_ATTRIBUTES_TAG = 0x03
+_IPP_INTEGER_TAG = 0x21
+_IPP_KEYWORD_TAG = 0x44
+_IPP_NAME_TAG = 0x42
+_IPP_URI_TAG = 0x45
+_IPP_CHARSET_TAG = 0x47
+_IPP_NATURAL_LANGUAGE_TAG = 0x48
+_IPP_MIME_MEDIA_TYPE_TAG = 0x49
+
+_ipp_job_states = {
+    3: "pending",
+    4: "pending",
+    5: "pending",
+    6: "pending",
+    7: "failed",
+    8: "failed",
+    9: "completed",
+}
+
+
+class IppError(ValueError):
+    def __init__(self, status_code):
+        super().__init__(f"Printer refused request with IPP status {status_code:#06x}")
+        self.status_code = status_code
+
+
+def _encode_ipp_attribute(tag, name, value):
+    name_bytes = name.encode("utf-8")
+    value_bytes = value if isinstance(value, bytes) else value.encode("utf-8")
+
+    return (
+        struct.pack(">BH", tag, len(name_bytes))
+        + name_bytes
+        + struct.pack(">H", len(value_bytes))
+        + value_bytes
+    )
+
+
+def _decode_ipp_response(content):
+    (status_code,) = struct.unpack_from(">H", content, 2)
+
+    attributes = {}
+    offset = 8
+
+    while offset < len(content):
+        tag = content[offset]
+        offset += 1
+
+        if tag == _IPP_END_OF_ATTRIBUTES_TAG:
+            break
+
+        if tag < 0x10:
+            continue
+
+        (name_length,) = struct.unpack_from(">H", content, offset)
+        offset += 2
+        name = content[offset : offset + name_length]
+        offset += name_length
+
+        (value_length,) = struct.unpack_from(">H", content, offset)
+        offset += 2
+        value = content[offset : offset + value_length]
+        offset += value_length
+
+        if name:
+            attributes[name.decode("utf-8")] = (tag, value)
+
+    return status_code, attributes
+
+
+class IppPrinter:
+    def __init__(
+        self,
+        printer_uri,
+        document_format="application/vnd.cups-raw",
+        user="kitchen",
+        timeout=(3.05, 20),
+    ):
+        self.printer_uri = printer_uri
+        self.document_format = document_format
+        self.user = user
+        self.timeout = timeout
+
+        uri = urlsplit(printer_uri)
+        http_scheme = "https" if uri.scheme == "ipps" else "http"
+        http_netloc = uri.netloc if uri.port else f"{uri.netloc}:631"
+        self.http_url = urlunsplit((http_scheme, http_netloc, uri.path, "", ""))
+
+        self.session = requests.Session()
+        self.session.headers.update({"content-type": "application/ipp"})
+
+        self.request_id = 0
+
+    def _request(self, operation, attributes, data=b""):
+        self.request_id += 1
+
+        request = b"".join(
+            [
+                struct.pack(">BBHI", 1, 1, operation, self.request_id),
+                bytes([_IPP_OPERATION_ATTRIBUTES_TAG]),
+                _encode_ipp_attribute(_IPP_CHARSET_TAG, "attributes-charset", "utf-8"),
+                _encode_ipp_attribute(
+                    _IPP_NATURAL_LANGUAGE_TAG, "attributes-natural-language", "en"
+                ),
+                _encode_ipp_attribute(_IPP_URI_TAG, "printer-uri", self.printer_uri),
+                _encode_ipp_attribute(_IPP_NAME_TAG, "requesting-user-name", self.user),
+                *(
+                    _encode_ipp_attribute(tag, name, value)
+                    for tag, name, value in attributes
+                ),
+                bytes([_IPP_END_OF_ATTRIBUTES_TAG]),
+                data,
+            ]
+        )
+
+        response = self.session.post(self.http_url, data=request, timeout=self.timeout)
+        response.raise_for_status()
+
+        status_code, attributes = _decode_ipp_response(response.content)
+
+        if status_code >= 0x0100:
+            raise IppError(status_code)
+
+        return attributes
+
+    def print(self, data):
+        attributes = self._request(
+            _IPP_PRINT_JOB,
+            [(_IPP_MIME_MEDIA_TYPE_TAG, "document-format", self.document_format)],
+            data,
+        )
+
+        try:
+            _, job_id = attributes["job-id"]
+        except KeyError:
+            raise ValueError("Unable to extract job-id")
+
+        return f"ipp-{int.from_bytes(job_id, 'big')}"
+
+    def job_state(self, print_id):
+        job_id = int(print_id.removeprefix("ipp-"))
+
+        try:
+            attributes = self._request(
+                _IPP_GET_JOB_ATTRIBUTES,
+                [
+                    (_IPP_INTEGER_TAG, "job-id", struct.pack(">i", job_id)),
+                    (_IPP_KEYWORD_TAG, "requested-attributes", "job-state"),
+                ],
+            )
+        except IppError as e:
+            if e.status_code == _IPP_NOT_FOUND:
+                return "unknown"
+
+            raise
+
+        try:
+            _, job_state = attributes["job-state"]
+        except KeyError:
+            raise ValueError(f"Unable to extract job-state of {print_id}")
+
+        return _ipp_job_states.get(int.from_bytes(job_state, "big"), "pending")
+
+    def cancel_job(self, print_id):
+        job_id = int(print_id.removeprefix("ipp-"))
+
+        try:
+            self._request(
+                _IPP_CANCEL_JOB,
+                [(_IPP_INTEGER_TAG, "job-id", struct.pack(">i", job_id))],
+            )
+        except IppError as e:
+            if e.status_code != _IPP_NOT_FOUND:
+                raise
+
+    def close(self):
+        self.session.close()
+
+
+def create_printer(config):
+    backend = config.get("PRINTER_BACKEND", "lp")
+
+    if backend == "lp":
+        return LpPrinter(config.get("PRINTER_DESTINATION"))
+
+    if backend == "raw":
+        return RawPrinter(config["PRINTER_HOST"], int(config.get("PRINTER_PORT", 9100)))
+
+    if backend == "ipp":
+        return IppPrinter(config["PRINTER_URI"])
+
+    raise ValueError(f"Unknown printer backend {backend}")
+
+
+class PrintQueue:
+    def __init__(self, printer, max_batch=5):
+        self.printer = printer
+        self.max_batch = max_batch
+
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def put(self, job_id, data):
+        with self.lock:
+            if job_id not in self.jobs:
+                self.jobs[job_id] = data
+
+    def print_next(self):
+        with self.lock:
+            batch = list(self.jobs.items())[: self.max_batch]
+
+        return batch, self.printer.print(b"".join(data for _, data in batch))
+
+    def remove(self, batch):
+        with self.lock:
+            for job_id, _ in batch:
+                self.jobs.pop(job_id, None)
+
+    def flush(self):
+        while self.jobs:
+            batch, print_id = self.print_next()
+            self.remove(batch)
+
+            yield batch, print_id
+
+
+def route_receipt(routes, receipt, default_printer="default"):
+    for route in routes:
+        if all(
+            receipt.get(field) == value
+            for field, value in route.items()
+            if field != "printer"
+        ):
+            return route["printer"]
+
+    return default_printer
+
+
+class TestRouteReceipt(unittest.TestCase):
+    def test_picks_first_matching_route(self):
+        routes = [
+            {"platform": "glovo", "type": "FR", "printer": "counter"},
+            {"station": "bar", "printer": "bar"},
+            {"platform": "glovo", "printer": "kitchen"},
+        ]
+
+        self.assertEqual(
+            route_receipt(routes, {"platform": "glovo", "type": "FR"}), "counter"
+        )
+        self.assertEqual(
+            route_receipt(routes, {"platform": "glovo", "type": "FT"}), "kitchen"
+        )
+        self.assertEqual(
+            route_receipt(routes, {"platform": "glovo", "station": "bar"}), "bar"
+        )
+        self.assertEqual(route_receipt(routes, {"type": "FR"}), "default")
+
+
+class TestRawPrinter(unittest.TestCase):
+    def setUp(self):
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.received = []
+        self.connections = 0
+
+        def accept_jobs():
+            while True:
+                try:
+                    connection, _ = self.listener.accept()
+                except OSError:
+                    return
+
+                self.connections += 1
+
+                with connection:
+                    while data := connection.recv(4096):
+                        self.received.append(data)
+
+        self.listener_thread = threading.Thread(target=accept_jobs, daemon=True)
+        self.listener_thread.start()
+
+        self.printer = RawPrinter(*self.listener.getsockname())
+
+    def tearDown(self):
+        self.printer.close()
+        self.listener.close()
+
+    def wait_received(self, expected):
+        deadline = time.monotonic() + 2
+
+        while b"".join(self.received) != expected and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(b"".join(self.received), expected)
+
+    def test_batches_queued_taloes_over_one_connection(self):
+        print_queue = PrintQueue(self.printer, max_batch=2)
+
+        print_queue.put(1, b"talao1")
+        print_queue.put(2, b"talao2")
+        print_queue.put(2, b"talao2")
+        print_queue.put(3, b"talao3")
+
+        batches = [[job_id for job_id, _ in batch] for batch, _ in print_queue.flush()]
+
+        self.assertEqual(batches, [[1, 2], [3]])
+        self.assertEqual(len(print_queue), 0)
+        self.wait_received(b"talao1talao2talao3")
+        self.assertEqual(self.connections, 1)
+
+    def test_keeps_jobs_queued_when_printer_is_offline(self):
+        with socket.socket() as unused_socket:
+            unused_socket.bind(("127.0.0.1", 0))
+            offline_printer = RawPrinter(*unused_socket.getsockname())
+
+        print_queue = PrintQueue(offline_printer)
+        print_queue.put(1, b"talao1")
+
+        with self.assertRaises(OSError):
+            list(print_queue.flush())
+
+        self.assertEqual(len(print_queue), 1)
+
+
+class TestLpPrinter(unittest.TestCase):
+    def setUp(self):
+        job_states = {1: 5, 2: 7, 3: 8, 4: 9}
+        self.requests = []
+
+        class IppHandler(http.server.BaseHTTPRequestHandler):
+            def do_POST(handler):
+                request = handler.rfile.read(int(handler.headers["content-length"]))
+                _, attributes = _decode_ipp_response(request)
+                _, job_id = attributes["job-id"]
+                _, printer_uri = attributes["printer-uri"]
+                self.requests.append(printer_uri.decode("utf-8"))
+
+                job_state = job_states.get(int.from_bytes(job_id, "big"))
+
+                if job_state:
+                    status_code = 0
+                    job_attributes = _encode_ipp_attribute(
+                        _IPP_INTEGER_TAG, "job-state", struct.pack(">i", job_state)
+                    )
+                else:
+                    status_code = _IPP_NOT_FOUND
+                    job_attributes = b""
+
+                body = b"".join(
+                    [
+                        struct.pack(">BBHI", 1, 1, status_code, 1),
+                        bytes([_IPP_OPERATION_ATTRIBUTES_TAG]),
+                        job_attributes,
+                        bytes([_IPP_END_OF_ATTRIBUTES_TAG]),
+                    ]
+                )
+
+                handler.send_response(200)
+                handler.send_header("content-type", "application/ipp")
+                handler.send_header("content-length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = http.server.HTTPServer(("127.0.0.1", 0), IppHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        host, port = self.server.server_address
+        self.printer = LpPrinter(cups_host=f"{host}:{port}")
+
+    def tearDown(self):
+        self.printer.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reports_cups_job_state(self):
+        self.assertEqual(self.printer.job_state("kitchen-1"), "pending")
+        self.assertEqual(self.printer.job_state("kitchen-2"), "failed")
+        self.assertEqual(self.printer.job_state("kitchen-3"), "failed")
+        self.assertEqual(self.printer.job_state("bar-printer-4"), "completed")
+        self.assertEqual(self.printer.job_state("kitchen-5"), "unknown")
+
+        host, port = self.server.server_address
+        self.assertEqual(self.requests[-2], f"ipp://{host}:{port}/printers/bar-printer")
+
+    def test_cancels_jobs_cups_already_forgot(self):
+        self.printer.cancel_job("kitchen-5")
+
+        self.assertEqual(len(self.requests), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,80 +1,435 @@
-import sqlite3
-import re
-import subprocess
+import asyncio
+import sys
 import logging
+import threading
 import time
+import unittest
+from datetime import datetime
 
-from tendo import singleton
+from dotenv import dotenv_values
 
+from printers import PrintQueue, create_printer, route_receipt
+from wakeup import watch_wakeups
+from database import (
+    connect,
+    decompress_talao,
+    format_stage_time,
+    parse_stage_time,
+    store_talao,
+)
+from metrics import loop_seconds, observe_stages
+from runtime import ComponentHalted, Topic, single_instance
+from sites import Site, load_sites
 
-def extract_print_id(print_output):
-    m = re.search("request id is\s(.+?)\s\(", print_output)
 
-    if m:
-        return m.group(1)
-    else:
-        return None
+def create_print_queue(config):
+    printer = create_printer(config)
 
+    return PrintQueue(printer, max_batch=int(config.get("PRINTER_BATCH_SIZE", 5)))
 
-me = singleton.SingleInstance()
 
-logging.basicConfig(format="%(asctime)s %(message)s", level=logging.DEBUG)
+def create_print_queues(site):
+    return {
+        name: create_print_queue(printer_config)
+        for name, printer_config in site.printer_configs.items()
+    }
 
-invoices = sqlite3.connect("invoices.db")
 
-logging.debug("Starting printer")
+class PrinterWorker:
+    def __init__(
+        self,
+        invoices,
+        site,
+        name,
+        print_queue,
+        confirm_seconds=1,
+        confirm_timeout_seconds=300,
+    ):
+        self.invoices = invoices
+        self.site = site
+        self.name = name
+        self.print_queue = print_queue
+        self.confirm_seconds = confirm_seconds
+        self.confirm_timeout_seconds = confirm_timeout_seconds
 
-while True:
+        self.unconfirmed = {}
+        self.sent_at = {}
+        self.stages = {}
+        self.wakeup = asyncio.Event()
 
-    try:
-        cursor = invoices.cursor()
+    def put(self, _id, talao, stages=None):
+        self.print_queue.put(_id, talao)
+
+        if stages:
+            self.stages[_id] = stages
+
+        self.wakeup.set()
+
+    def _update_invoices(self, query, params):
+        try:
+            self.invoices.executemany(query, params)
+            self.invoices.commit()
+        except Exception:
+            logging.exception("Failed to update print state of %s", params)
+            raise ComponentHalted("Will exit to prevent duplicated printing")
+
+    async def print_next(self):
+        batch, print_id = await asyncio.to_thread(self.print_queue.print_next)
+
+        self.print_queue.remove(batch)
+        invoice_ids = [_id for _id, _ in batch]
+
+        logging.debug("Printer %s accepted %s as %s", self.name, invoice_ids, print_id)
 
-        cursor.execute(
-            "select id, delivery_code, talao from invoice where print_id is null"
+        self._update_invoices(
+            "update invoice set print_id = (?), printer = (?), print_state = 'queued' where id = (?)",
+            [(print_id, self.name, _id) for _id in invoice_ids],
         )
-        rows = cursor.fetchall()
 
-        for _id, code, talao in rows:
-            logging.debug("Will print %s %s", _id, code)
+        self.unconfirmed[print_id] = batch
+        self.sent_at[print_id] = time.monotonic()
 
+    async def _expire_job(self, print_id):
+        if time.monotonic() - self.sent_at[print_id] < self.confirm_timeout_seconds:
+            return "pending"
+
+        logging.warning(
+            "Print job %s was not confirmed on %s in %ds. Will cancel it",
+            print_id,
+            self.name,
+            self.confirm_timeout_seconds,
+        )
+
+        try:
+            await asyncio.to_thread(self.print_queue.printer.cancel_job, print_id)
+        except Exception:
+            logging.exception(
+                "Failed to cancel print job %s on %s", print_id, self.name
+            )
+
+        return "failed"
+
+    async def confirm_jobs(self):
+        for print_id, batch in list(self.unconfirmed.items()):
             try:
-                completed_process = subprocess.run(
-                    ["lp"], capture_output=True, input=talao, timeout=5
+                job_state = await asyncio.to_thread(
+                    self.print_queue.printer.job_state, print_id
                 )
-                completed_process.check_returncode()
+            except Exception:
+                logging.exception(
+                    "Failed to confirm print job %s on %s", print_id, self.name
+                )
+                job_state = "pending"
+
+            if job_state == "pending":
+                job_state = await self._expire_job(print_id)
+
+            if job_state == "pending":
+                continue
 
-                logging.debug(
-                    "Printer service responded with %s", completed_process.stdout
+            del self.unconfirmed[print_id]
+            del self.sent_at[print_id]
+            invoice_ids = [_id for _id, _ in batch]
+
+            if job_state == "unknown":
+                logging.warning(
+                    "Print job %s is no longer known on %s. Assuming it printed",
+                    print_id,
+                    self.name,
                 )
 
-                output_str = completed_process.stdout.decode("utf-8")
+            if job_state in ("completed", "unknown"):
+                printed_at = datetime.now()
+
+                self._update_invoices(
+                    "update invoice set print_state = 'printed', printed_at = (?) where id = (?)",
+                    [(format_stage_time(printed_at), _id) for _id in invoice_ids],
+                )
 
-                try:
-                    print_id = extract_print_id(output_str)
-                    if not print_id:
-                        raise ValueError("Unable to extract print_id")
+                logging.info("Printed %s on %s as %s", invoice_ids, self.name, print_id)
 
-                    cursor.execute(
-                        "update invoice set print_id = (?) where id = (?)",
-                        (
-                            print_id,
-                            _id,
-                        ),
+                for _id in invoice_ids:
+                    observe_stages(
+                        {**self.stages.pop(_id, {}), "printed_at": printed_at}
                     )
-                    invoices.commit()
+            else:
+                self._update_invoices(
+                    "update invoice set print_id = null, printer = null, print_state = null where id = (?)",
+                    [(_id,) for _id in invoice_ids],
+                )
+
+                logging.warning(
+                    "Print job %s failed on %s. Will print %s again",
+                    print_id,
+                    self.name,
+                    invoice_ids,
+                )
 
-                    logging.info("Printed %s %s as %s", _id, code, print_id)
-                except Exception:
-                    logging.exception("Failed to mark invoice as printed")
-                    sys.exit("Will exit to prevent duplicated printing")
+                for _id, talao in batch:
+                    self.put(_id, talao)
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            iteration_started_at = time.perf_counter()
+
+            try:
+                while self.print_queue:
+                    await self.print_next()
 
-            except (SystemExit, KeyboardInterrupt):
+                await self.confirm_jobs()
+            except ComponentHalted:
                 raise
             except Exception:
-                logging.exception("Failed to print. Will retry %s %s", _id, code)
-    except (SystemExit, KeyboardInterrupt):
-        raise
-    except Exception:
-        logging.exception("Unexpected failure. Will retry")
+                logging.exception(
+                    "Failed to print on %s. Will retry %s",
+                    self.name,
+                    list(self.print_queue.jobs),
+                )
+
+            loop_seconds.observe(
+                time.perf_counter() - iteration_started_at,
+                loop=f"printer:{self.site.name}:{self.name}",
+            )
+
+            busy = self.print_queue or self.unconfirmed
+
+            try:
+                await asyncio.wait_for(
+                    self.wakeup.wait(), self.confirm_seconds if busy else None
+                )
+            except asyncio.TimeoutError:
+                pass
+
+
+def load_unconfirmed_jobs(invoices, site, workers):
+    cursor = invoices.cursor()
+
+    cursor.execute(
+        "select invoice.id, talao.data, invoice.print_id, invoice.printer from invoice join talao on talao.hash = invoice.talao_hash where invoice.facility_id = (?) and invoice.print_state = 'queued'",
+        (site.facility_id,),
+    )
+
+    for _id, talao_data, print_id, printer in cursor.fetchall():
+        worker = workers.get(printer)
+
+        if not worker:
+            logging.warning(
+                "Unable to confirm print job %s of %s on unknown printer %s",
+                print_id,
+                _id,
+                printer,
+            )
+            continue
+
+        worker.unconfirmed.setdefault(print_id, []).append(
+            (_id, decompress_talao(talao_data))
+        )
+        worker.sent_at[print_id] = time.monotonic()
+
+
+async def route_receipts(invoices, site, workers, saved_topic):
+    version = saved_topic.version
+
+    while True:
+        iteration_started_at = time.perf_counter()
+
+        try:
+            cursor = invoices.cursor()
+
+            cursor.execute(
+                "select invoice.id, invoice.delivery_code, talao.data, invoice.started_at, invoice.saved_at, invoice.platform, invoice.type, invoice.station from invoice join talao on talao.hash = invoice.talao_hash where invoice.facility_id = (?) and invoice.print_state is null",
+                (site.facility_id,),
+            )
+            rows = cursor.fetchall()
+
+            for _id, code, talao_data, started_at, saved_at, *receipt in rows:
+                printer = route_receipt(
+                    site.print_routes,
+                    dict(zip(("platform", "type", "station"), receipt)),
+                )
+
+                logging.debug("Will print %s %s on %s", _id, code, printer)
+
+                workers[printer].put(
+                    _id,
+                    decompress_talao(talao_data),
+                    {
+                        "started_at": parse_stage_time(started_at),
+                        "saved_at": parse_stage_time(saved_at),
+                    },
+                )
+        except Exception:
+            logging.exception("Unexpected failure. Will retry")
+
+        loop_seconds.observe(
+            time.perf_counter() - iteration_started_at, loop=f"printing:{site.name}"
+        )
 
-    time.sleep(1)
+        await saved_topic.wait_newer(version, 60)
+        version = saved_topic.version
+
+
+async def print_receipts(invoices, site, print_queues, saved_topic):
+    workers = {
+        name: PrinterWorker(invoices, site, name, print_queue)
+        for name, print_queue in print_queues.items()
+    }
+
+    load_unconfirmed_jobs(invoices, site, workers)
+
+    tasks = [asyncio.create_task(worker.run()) for worker in workers.values()]
+    tasks.append(
+        asyncio.create_task(route_receipts(invoices, site, workers, saved_topic))
+    )
+
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class _FakePrinter:
+    def __init__(self):
+        self.printing = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.printed = []
+        self.job_states = {}
+        self.canceled = []
+
+    def print(self, data):
+        self.printing.set()
+        self.release.wait(2)
+        self.printed.append(data)
+
+        return f"job-{len(self.printed)}"
+
+    def job_state(self, print_id):
+        job_state = self.job_states.get(print_id, "pending")
+
+        if isinstance(job_state, Exception):
+            raise job_state
+
+        return job_state
+
+    def cancel_job(self, print_id):
+        self.canceled.append(print_id)
+
+
+class TestPrinterWorker(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.invoices = connect(":memory:")
+        self.site = Site(
+            {},
+            {"name": "test", "facility_id": "f", "register_id": 1, "payment_id": 1},
+            primary=True,
+        )
+        self.printer = _FakePrinter()
+        self.worker = PrinterWorker(
+            self.invoices, self.site, "default", PrintQueue(self.printer)
+        )
+
+    def tearDown(self):
+        self.invoices.close()
+
+    def save_invoice(self, _id, talao):
+        self.invoices.execute(
+            "insert into invoice(id, facility_id, talao_hash, saved_at) values (?, 'f', ?, '2026-10-18T12:00:00')",
+            (_id, store_talao(self.invoices, talao)),
+        )
+        self.invoices.commit()
+
+    def print_states(self):
+        return self.invoices.execute(
+            "select id, print_id, print_state from invoice order by id"
+        ).fetchall()
+
+    async def test_ignores_receipt_routed_again_while_printing(self):
+        self.save_invoice(1, b"talao1")
+        self.printer.release.clear()
+
+        self.worker.put(1, b"talao1")
+        printing = asyncio.create_task(self.worker.print_next())
+        await asyncio.to_thread(self.printer.printing.wait, 2)
+
+        self.assertEqual(self.print_states(), [(1, None, None)])
+        self.worker.put(1, b"talao1")
+
+        self.printer.release.set()
+        await printing
+
+        self.assertEqual(len(self.worker.print_queue), 0)
+        self.assertEqual(self.printer.printed, [b"talao1"])
+        self.assertEqual(self.print_states(), [(1, "job-1", "queued")])
+
+    async def print_receipts(self, *receipts):
+        for _id, talao in receipts:
+            self.save_invoice(_id, talao)
+            self.worker.put(_id, talao)
+            await self.worker.print_next()
+
+    async def test_confirms_each_job_on_its_own(self):
+        await self.print_receipts((1, b"talao1"), (2, b"talao2"), (3, b"talao3"))
+        self.printer.job_states = {
+            "job-1": ValueError("CUPS is restarting"),
+            "job-2": "unknown",
+            "job-3": "completed",
+        }
+
+        with self.assertLogs(level="WARNING"):
+            await self.worker.confirm_jobs()
+
+        self.assertEqual(list(self.worker.unconfirmed), ["job-1"])
+        self.assertEqual(
+            self.print_states(),
+            [(1, "job-1", "queued"), (2, "job-2", "printed"), (3, "job-3", "printed")],
+        )
+
+    async def test_reprints_jobs_not_confirmed_in_time(self):
+        await self.print_receipts((1, b"talao1"))
+        await self.worker.confirm_jobs()
+
+        self.assertEqual(self.print_states(), [(1, "job-1", "queued")])
+
+        self.worker.confirm_timeout_seconds = 0
+
+        with self.assertLogs(level="WARNING"):
+            await self.worker.confirm_jobs()
+
+        self.assertEqual(self.printer.canceled, ["job-1"])
+        self.assertEqual(self.print_states(), [(1, None, None)])
+        self.assertEqual(list(self.worker.print_queue.jobs), [1])
+        self.assertEqual(self.worker.unconfirmed, {})
+
+
+async def main():
+    invoices = connect()
+
+    config = dotenv_values(".env")
+
+    components = []
+
+    for site in load_sites(config):
+        saved_topic = Topic()
+
+        components += [
+            watch_wakeups(site.printing_wakeup_path, saved_topic),
+            print_receipts(invoices, site, create_print_queues(site), saved_topic),
+        ]
+
+    await asyncio.gather(*components)
+
+
+if __name__ == "__main__":
+    me = single_instance("printing")
+
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.DEBUG)
+
+    logging.debug("Starting printer")
+
+    try:
+        asyncio.run(main())
+    except ComponentHalted as e:
+        sys.exit(str(e))
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import os
+import tempfile
+
+from tendo import singleton
+
+
+class ComponentHalted(Exception):
+    pass
+
+
+class Topic:
+    def __init__(self):
+        self.version = 0
+        self.value = None
+
+        self._published = asyncio.Event()
+
+    def publish(self, value):
+        self.value = value
+        self.version += 1
+
+        self._published.set()
+        self._published = asyncio.Event()
+
+    async def wait_newer(self, version, timeout=None):
+        if self.version > version:
+            return True
+
+        try:
+            await asyncio.wait_for(self._published.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+        return True
+
+
+def single_instance(component):
+    working_dir = os.getcwd().replace(os.sep, "-")
+    lockfile = os.path.join(
+        tempfile.gettempdir(), f"kitchen{working_dir}-{component}.lock"
+    )
+
+    return singleton.SingleInstance(lockfile=lockfile)
+
+
+async def supervise(name, run_component, restart_seconds=5):
+    while True:
+        try:
+            await run_component()
+
+            return
+        except ComponentHalted:
+            logging.critical("Component %s halted", name, exc_info=True)
+
+            return
+        except Exception:
+            logging.exception("Component %s crashed. Will restart", name)
+
+        await asyncio.sleep(restart_seconds)
+
+
+async def run_components(components):
+    await asyncio.gather(
+        *(supervise(name, run_component) for name, run_component in components.items())
+    )
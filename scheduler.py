@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import time
+import unittest
+from datetime import datetime, timedelta
+
+_weekdays = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+
+def _parse_days(days):
+    weekdays = set()
+
+    for day_range in days.split(","):
+        first, _, last = day_range.partition("-")
+        first_index = _weekdays.index(first)
+        last_index = _weekdays.index(last or first)
+
+        weekdays.update(
+            _weekdays[index % 7]
+            for index in range(
+                first_index, first_index + (last_index - first_index) % 7 + 1
+            )
+        )
+
+    return frozenset(_weekdays.index(day) for day in weekdays)
+
+
+def _parse_time(value):
+    hours, minutes = value.split(":")
+
+    return int(hours) * 60 + int(minutes)
+
+
+class OpeningHours:
+    def __init__(self, shifts):
+        self.shifts = shifts
+
+    @classmethod
+    def parse(cls, calendar):
+        shifts = []
+
+        for entry in calendar.split(";"):
+            fields = entry.strip().lower().split()
+
+            if fields and ":" not in fields[0]:
+                weekdays = _parse_days(fields.pop(0))
+            else:
+                weekdays = frozenset(range(7))
+
+            for hours in fields:
+                opens, closes = hours.split("-")
+                shifts.append((weekdays, _parse_time(opens), _parse_time(closes)))
+
+        return cls(shifts)
+
+    def is_open(self, moment):
+        minute = moment.hour * 60 + moment.minute
+        weekday = moment.weekday()
+        previous_weekday = (weekday - 1) % 7
+
+        for weekdays, opens, closes in self.shifts:
+            if opens < closes:
+                if weekday in weekdays and opens <= minute < closes:
+                    return True
+            elif (weekday in weekdays and minute >= opens) or (
+                previous_weekday in weekdays and minute < closes
+            ):
+                return True
+
+        return False
+
+
+def create_opening_hours(config):
+    calendar = config.get("OPENING_HOURS")
+
+    return OpeningHours.parse(calendar) if calendar else None
+
+
+class PollScheduler:
+    def __init__(
+        self,
+        name,
+        busy_seconds,
+        idle_seconds,
+        closed_seconds=300,
+        opening_hours=None,
+        report_seconds=300,
+        clock=time.monotonic,
+        now=datetime.now,
+    ):
+        self.name = name
+        self.busy_seconds = busy_seconds
+        self.idle_seconds = idle_seconds
+        self.closed_seconds = closed_seconds
+        self.opening_hours = opening_hours
+        self.report_seconds = report_seconds
+        self.clock = clock
+        self.now = now
+
+        self.interval = busy_seconds
+        self.mode = None
+        self.polls = 0
+        self.reported_at = clock()
+
+    def next_interval(self, busy=False, failed=False):
+        is_open = not self.opening_hours or self.opening_hours.is_open(self.now())
+
+        if failed:
+            mode = "failing"
+            backoff_limit = self.idle_seconds if is_open else self.closed_seconds
+            interval = min(backoff_limit, max(self.interval, self.busy_seconds) * 2)
+        elif busy:
+            mode = "busy"
+            interval = self.busy_seconds
+        elif not is_open:
+            mode = "closed"
+            interval = self.closed_seconds
+        else:
+            mode = "idle"
+            interval = min(self.idle_seconds, self.interval * 2)
+
+        if mode != self.mode:
+            logging.info("Polling %s every %.1fs while %s", self.name, interval, mode)
+
+        self.mode = mode
+        self.interval = interval
+        self.polls += 1
+
+        self._report()
+
+        return interval
+
+    def _report(self):
+        elapsed = self.clock() - self.reported_at
+
+        if elapsed < self.report_seconds:
+            return
+
+        logging.info(
+            "Polled %s %d times in %.0fs (%.2f/min), now every %.1fs while %s",
+            self.name,
+            self.polls,
+            elapsed,
+            self.polls * 60 / elapsed,
+            self.interval,
+            self.mode,
+        )
+
+        self.polls = 0
+        self.reported_at = self.clock()
+
+    async def sleep(self, busy=False, failed=False):
+        await asyncio.sleep(self.next_interval(busy, failed))
+
+
+class TestOpeningHours(unittest.TestCase):
+    def test_every_day(self):
+        opening_hours = OpeningHours.parse("11:30-15:00 18:30-23:00")
+
+        self.assertTrue(opening_hours.is_open(datetime(2024, 6, 3, 12, 0)))
+        self.assertFalse(opening_hours.is_open(datetime(2024, 6, 3, 16, 0)))
+        self.assertFalse(opening_hours.is_open(datetime(2024, 6, 3, 23, 0)))
+
+    def test_weekdays_and_past_midnight(self):
+        opening_hours = OpeningHours.parse("mon-thu 12:00-23:00; fri-sat 18:00-02:00")
+
+        # 2024-06-07 is a friday
+        self.assertTrue(opening_hours.is_open(datetime(2024, 6, 7, 20, 0)))
+        self.assertTrue(opening_hours.is_open(datetime(2024, 6, 8, 1, 0)))
+        self.assertTrue(opening_hours.is_open(datetime(2024, 6, 9, 1, 0)))
+        self.assertFalse(opening_hours.is_open(datetime(2024, 6, 9, 12, 0)))
+        self.assertFalse(opening_hours.is_open(datetime(2024, 6, 7, 1, 0)))
+
+    def test_wrapping_day_range(self):
+        opening_hours = OpeningHours.parse("sat-mon 10:00-12:00")
+
+        self.assertTrue(opening_hours.is_open(datetime(2024, 6, 9, 11, 0)))
+        self.assertTrue(opening_hours.is_open(datetime(2024, 6, 10, 11, 0)))
+        self.assertFalse(opening_hours.is_open(datetime(2024, 6, 11, 11, 0)))
+
+
+class TestPollScheduler(unittest.TestCase):
+    def setUp(self):
+        self.moment = datetime(2024, 6, 3, 12, 0)
+        self.scheduler = PollScheduler(
+            "test",
+            busy_seconds=2,
+            idle_seconds=10,
+            closed_seconds=120,
+            opening_hours=OpeningHours.parse("11:00-23:00"),
+            now=lambda: self.moment,
+        )
+
+    def test_backs_off_when_idle(self):
+        intervals = [self.scheduler.next_interval() for _ in range(4)]
+
+        self.assertEqual(intervals, [4, 8, 10, 10])
+        self.assertEqual(self.scheduler.next_interval(busy=True), 2)
+
+    def test_backs_off_after_errors(self):
+        self.scheduler.next_interval(busy=True)
+
+        intervals = [self.scheduler.next_interval(failed=True) for _ in range(4)]
+
+        self.assertEqual(intervals, [4, 8, 10, 10])
+
+    def test_slows_down_when_closed(self):
+        self.moment += timedelta(hours=12)
+
+        self.assertEqual(self.scheduler.next_interval(), 120)
+        self.assertEqual(self.scheduler.next_interval(busy=True), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,509 @@
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import re
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import metrics
+import orders
+from database import connect
+from invoicing import Invoicer
+from mapping import InvoiceMappingFile
+from otter import OtterClient
+from printers import PrintQueue
+from printing import print_receipts
+from runtime import Topic, run_components
+from sites import Site
+from vendus import AsyncVendusClient
+
+friday_peak = "60:10,300:30,120:10"
+
+
+def parse_curve(curve):
+    segments = []
+
+    for segment in curve.split(","):
+        orders_per_hour, minutes = segment.split(":")
+        segments.append((float(orders_per_hour), float(minutes)))
+
+    return segments
+
+
+def google_money(cents):
+    return {"units": cents // 100, "nanos": cents % 100 * 10**7}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self._send_json(*self.server.stand_in.get(url.path, parse_qs(url.query)))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        self._send_json(*self.server.stand_in.post(url.path, self._read_json()))
+
+
+def serve_stand_in(stand_in):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    server.stand_in = stand_in
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+class FakeOtter:
+    def __init__(self, menu, active_seconds, rng):
+        self.menu = menu
+        self.active_seconds = active_seconds
+        self.rng = rng
+
+        self.lock = threading.Lock()
+        self.orders = {}
+        self.accepted_at = {}
+        self.requests = Counter()
+
+    def add_order(self):
+        code = f"SIM{len(self.accepted_at) + 1:05d}"
+        items = []
+        total_cents = 0
+
+        for sku_id, name, price_cents in self.rng.sample(
+            self.menu, self.rng.randint(1, 4)
+        ):
+            quantity = self.rng.choice([1, 1, 1, 2, 3])
+            total_cents += price_cents * quantity
+
+            items.append(
+                {
+                    "skuId": {"id": sku_id},
+                    "stationItemDetail": {
+                        "salePrice": google_money(price_cents),
+                        "quantity": quantity,
+                        "name": name,
+                        "note": None,
+                    },
+                    "itemModifiers": [],
+                }
+            )
+
+        now_iso = datetime.now(timezone.utc).isoformat()
+        phone = f"+3519{self.rng.randint(10000000, 99999999)}"
+
+        order = {
+            "createdAt": now_iso,
+            "customerOrder": {
+                "ofoSlug": self.rng.choice(["glovo", "bolt", "ubereats"]),
+                "externalOrderId": {"displayId": code},
+                "ofoStatus": "OFO_STATUS_ACCEPTED",
+                "customer": {"displayName": f"Customer {code}", "phone": phone},
+                "customerNote": None,
+                "customerPayment": {"total": google_money(total_cents)},
+                "stationOrders": [
+                    {
+                        "menuReconciledItemsContainer": {"items": items},
+                        "activatedAt": now_iso,
+                    }
+                ],
+                "readinessState": "READINESS_STATE_PREPARING",
+                "confirmationInfo": {
+                    "confirmationState": "CONFIRMATION_CONFIRMED",
+                    "estimatedPrepTimeMinutes": 15,
+                },
+            },
+        }
+
+        with self.lock:
+            self.orders[code] = order
+            self.accepted_at[code] = time.monotonic()
+
+    def _active_orders(self, limit):
+        expired_before = time.monotonic() - self.active_seconds
+
+        with self.lock:
+            for code in list(self.orders):
+                if self.accepted_at[code] < expired_before:
+                    del self.orders[code]
+
+            return list(self.orders.values())[-limit:]
+
+    def get(self, path, params):
+        self.requests[path] += 1
+
+        if path == "/ufo/otter_order_active":
+            limit = int(params.get("limit", ["75"])[0])
+
+            return 200, {"orders": self._active_orders(limit)}
+
+        return 404, {}
+
+    def post(self, path, data):
+        self.requests[path] += 1
+
+        if path == "/users/sign_in":
+            return 200, {"accessToken": "simulated"}
+
+        if path == "/graphql":
+            entities = [
+                {"sku": {"id": sku_id, "name": name}} for sku_id, name, _ in self.menu
+            ]
+
+            return 200, {"data": {"menuTemplate": {"entities": entities}}}
+
+        return 404, {}
+
+
+class FakeVendus:
+    def __init__(self, latency_seconds):
+        self.latency_seconds = latency_seconds
+
+        self.lock = threading.Lock()
+        self.clients = []
+        self.documents = {}
+        self.codes = {}
+        self.requests = Counter()
+
+    def get(self, path, params):
+        time.sleep(self.latency_seconds)
+
+        if path == "/ws/v1.1/clients/":
+            self.requests["search client"] += 1
+
+            filters = {
+                field: values[0]
+                for field, values in params.items()
+                if field in {"fiscal_id", "name", "external_reference"}
+            }
+
+            with self.lock:
+                clients = [
+                    client
+                    for client in self.clients
+                    if all(
+                        client.get(field) == value for field, value in filters.items()
+                    )
+                ]
+
+            return (200, clients) if clients else (404, {})
+
+        if path == "/ws/v1.1/documents/":
+            self.requests["list documents"] += 1
+
+            return 404, {}
+
+        document_id = int(path.rsplit("/", 1)[1])
+
+        with self.lock:
+            document = self.documents.get(document_id)
+
+        if not document:
+            return 404, {}
+
+        if params.get("output") == ["escpos"]:
+            self.requests["talao"] += 1
+
+            talao = f"SIMULATED {document_id}\n".encode("ascii")
+
+            return 200, {"output": base64.b64encode(talao).decode("ascii")}
+
+        self.requests["document"] += 1
+
+        return 200, document
+
+    def post(self, path, data):
+        time.sleep(self.latency_seconds)
+
+        if path == "/ws/v1.1/clients/":
+            self.requests["create client"] += 1
+
+            with self.lock:
+                client = {
+                    "id": len(self.clients) + 1,
+                    "fiscal_id": data.get("fiscal_id", ""),
+                    "mobile": data.get("mobile", ""),
+                    **data,
+                }
+                self.clients.append(client)
+
+            return 201, client
+
+        if path == "/ws/v1.1/documents/":
+            self.requests["create document"] += 1
+
+            amount_gross = sum(
+                Decimal(item["gross_price"]) * item["qty"] for item in data["items"]
+            )
+            now = datetime.now()
+
+            with self.lock:
+                document_id = len(self.documents) + 1
+                document = {
+                    "id": document_id,
+                    "number": f"FR SIM/{document_id}",
+                    "type": data.get("type", "FR"),
+                    "amount_gross": f"{amount_gross:.2f}",
+                    "date": now.strftime("%Y-%m-%d"),
+                    "local_time": now.strftime("%Y-%m-%d %H:%M:%S"),
+                    "external_reference": data.get("external_reference"),
+                }
+                self.documents[document_id] = document
+                self.codes[document_id] = data.get("external_reference")
+
+            return 201, document
+
+        return 404, {}
+
+
+class FakePrinter:
+    def __init__(self, seconds_per_receipt):
+        self.seconds_per_receipt = seconds_per_receipt
+
+        self.printed_at = {}
+        self.jobs = 0
+
+    def print(self, data):
+        document_ids = [int(_id) for _id in re.findall(rb"SIMULATED (\d+)", data)]
+
+        time.sleep(self.seconds_per_receipt * len(document_ids))
+
+        printed_at = time.monotonic()
+        for document_id in document_ids:
+            self.printed_at[document_id] = printed_at
+
+        self.jobs += 1
+
+        return f"simulated-{self.jobs}"
+
+    def job_state(self, print_id):
+        return "completed"
+
+    def cancel_job(self, print_id):
+        pass
+
+
+def load_menu(rng):
+    invoice_mapping = InvoiceMappingFile().get()
+
+    return [
+        (sku_id, f"Item {reference}", rng.randrange(150, 1500, 50))
+        for sku_id, reference in invoice_mapping.items.items()
+        if reference is not None
+    ]
+
+
+async def replay_orders(otter, curve, speedup, rng):
+    started_at = time.monotonic()
+    simulated_seconds = 0
+
+    for orders_per_hour, minutes in curve:
+        segment_end = simulated_seconds + minutes * 60
+
+        while orders_per_hour > 0:
+            simulated_seconds += rng.expovariate(orders_per_hour / 3600)
+
+            if simulated_seconds > segment_end:
+                break
+
+            await asyncio.sleep(
+                max(0, started_at + simulated_seconds / speedup - time.monotonic())
+            )
+
+            otter.add_order()
+
+        simulated_seconds = segment_end
+
+    await asyncio.sleep(
+        max(0, started_at + simulated_seconds / speedup - time.monotonic())
+    )
+
+
+async def wait_until_printed(otter, vendus, printer, timeout_seconds):
+    deadline = time.monotonic() + timeout_seconds
+
+    while time.monotonic() < deadline:
+        printed_codes = {vendus.codes.get(_id) for _id in printer.printed_at}
+
+        if printed_codes >= set(otter.accepted_at):
+            return
+
+        await asyncio.sleep(0.5)
+
+
+def report(otter, vendus, printer, curve, elapsed_seconds):
+    latencies = sorted(
+        printed_at - otter.accepted_at[vendus.codes[document_id]]
+        for document_id, printed_at in printer.printed_at.items()
+    )
+    simulated_hours = sum(minutes for _, minutes in curve) / 60
+
+    print(f"Orders accepted   {len(otter.accepted_at)}")
+    print(f"Invoices created  {len(vendus.documents)}")
+    print(f"Receipts printed  {len(latencies)} in {printer.jobs} print jobs")
+    print(
+        f"Elapsed           {elapsed_seconds:.1f}s ({simulated_hours:.2f}h simulated)"
+    )
+    print(f"Throughput        {len(latencies) / elapsed_seconds * 60:.1f} receipts/min")
+
+    if len(latencies) >= 2:
+        percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+
+        print(
+            "Latency           p50 {:.2f}s  p95 {:.2f}s  p99 {:.2f}s  max {:.2f}s".format(
+                percentiles[49], percentiles[94], percentiles[98], latencies[-1]
+            )
+        )
+
+    print(f"Otter requests    {dict(otter.requests)}")
+    print(f"Vendus requests   {dict(vendus.requests)}")
+
+
+async def simulate(args):
+    rng = random.Random(args.seed)
+    curve = parse_curve(args.curve)
+
+    otter = FakeOtter(load_menu(rng), args.active_minutes * 60 / args.speedup, rng)
+    vendus = FakeVendus(args.vendus_latency)
+    printer = FakePrinter(args.print_seconds)
+
+    otter_server, otter_url = serve_stand_in(otter)
+    vendus_server, vendus_url = serve_stand_in(vendus)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        client = OtterClient(
+            logging.getLogger("otter"),
+            "simulation",
+            "simulation",
+            base_url=otter_url,
+            session_cache_path=os.path.join(work_dir, "otter_session.json"),
+        )
+
+        invoices = connect(os.path.join(work_dir, "invoices.db"))
+
+        site = Site(
+            {},
+            {
+                "name": "simulation",
+                "facility_id": str(uuid.uuid4()),
+                "register_id": 1,
+                "payment_id": 1,
+            },
+            primary=True,
+        )
+        orders_topic = Topic()
+        saved_topic = Topic()
+
+        invoicer = Invoicer(
+            AsyncVendusClient(
+                "simulation", pool_size=args.concurrency, base_url=vendus_url
+            ),
+            invoices,
+            site,
+            saved_topic,
+            concurrency=args.concurrency,
+        )
+        print_queues = {"default": PrintQueue(printer, max_batch=args.batch_size)}
+
+        pipeline = asyncio.create_task(
+            run_components(
+                {
+                    "orders": lambda: orders.poll_orders(
+                        client,
+                        site,
+                        orders_topic,
+                        orders.create_orders_scheduler({}, site),
+                    ),
+                    "invoicing": lambda: invoicer.run(orders_topic),
+                    "printing": lambda: print_receipts(
+                        invoices, site, print_queues, saved_topic
+                    ),
+                }
+            )
+        )
+
+        started_at = time.monotonic()
+
+        try:
+            await replay_orders(otter, curve, args.speedup, rng)
+            await wait_until_printed(otter, vendus, printer, args.drain_seconds)
+        finally:
+            pipeline.cancel()
+
+            await asyncio.gather(pipeline, return_exceptions=True)
+
+            invoices.close()
+            otter_server.shutdown()
+            vendus_server.shutdown()
+
+    report(otter, vendus, printer, curve, time.monotonic() - started_at)
+
+    if args.metrics:
+        print(metrics.registry.render())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay simulated orders through orders, invoicing and printing"
+    )
+    parser.add_argument(
+        "--curve",
+        default=friday_peak,
+        help="arrival curve as orders_per_hour:minutes segments, defaults to a friday peak",
+    )
+    parser.add_argument(
+        "--speedup",
+        type=float,
+        default=10,
+        help="how much faster than real time to replay the curve",
+    )
+    parser.add_argument("--active-minutes", type=float, default=30)
+    parser.add_argument("--vendus-latency", type=float, default=0.3)
+    parser.add_argument("--print-seconds", type=float, default=0.5)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=5)
+    parser.add_argument("--drain-seconds", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument(
+        "--metrics", action="store_true", help="print the collected metrics"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(message)s",
+        level=logging.INFO if args.verbose else logging.WARNING,
+    )
+
+    asyncio.run(simulate(args))
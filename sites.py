@@ -0,0 +1,66 @@
+import json
+import os
+
+from wakeup import PRINTING_WAKEUP_PATH
+
+default_site = {
+    "name": "main",
+    "facility_id": "ec411c9b-34b2-391d-9d61-fbc9ef40fc8c",
+    "register_id": 94305980,
+    "payment_id": "94305968",
+}
+
+
+class Site:
+    def __init__(self, config, site, primary):
+        self.name = site["name"]
+        self.facility_id = site["facility_id"]
+        self.register_id = int(site["register_id"])
+        self.primary = primary
+
+        self.invoice_config = {
+            "type": site.get("invoice_type", "FR"),
+            "payments": [{"id": str(site["payment_id"])}],
+            "register_id": self.register_id,
+        }
+        self.printer_configs = {
+            "default": {**config, **site.get("printer", {})},
+            **{
+                name: {**config, **printer}
+                for name, printer in site.get("printers", {}).items()
+            },
+        }
+        self.print_routes = site.get("print_routes", [])
+
+        unknown_printers = {
+            route.get("printer") for route in self.print_routes
+        } - self.printer_configs.keys()
+        if unknown_printers:
+            raise ValueError(f"Routes of {self.name} to unknown {unknown_printers}")
+
+        suffix = "" if primary else f"-{self.name}"
+
+        self.orders_path = f"orders{suffix}.json"
+        self.manual_orders_path = f"manual_orders{suffix}.json"
+        self.printing_wakeup_path = (
+            PRINTING_WAKEUP_PATH if primary else f"printing{suffix}.sock"
+        )
+
+    def __repr__(self):
+        return f"Site({self.name!r}, {self.facility_id!r}, {self.register_id!r})"
+
+
+def load_sites(config, file_path=None):
+    file_path = file_path or config.get("SITES_FILE", "sites.json")
+
+    if not os.path.exists(file_path):
+        return [Site(config, default_site, primary=True)]
+
+    with open(file_path) as sites_file:
+        sites = json.load(sites_file)
+
+    names = [site["name"] for site in sites]
+    if not sites or len(set(names)) != len(names):
+        raise ValueError(f"Expects sites with unique names in {file_path}")
+
+    return [Site(config, site, primary=index == 0) for index, site in enumerate(sites)]
@@ -0,0 +1,138 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from wakeup import WakeupListener, send_wakeup
+
+
+def hash_orders(orders):
+    canonical_orders = json.dumps(orders, sort_keys=True, separators=(",", ":"))
+
+    return hashlib.sha256(canonical_orders.encode("utf-8")).hexdigest()
+
+
+def read_snapshot(file_path):
+    with open(file_path) as snapshot_file:
+        return json.load(snapshot_file)
+
+
+def write_atomically(file_path, content, mode=0o644):
+    directory = os.path.dirname(os.path.abspath(file_path))
+    file_name = os.path.basename(file_path)
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{file_name}.")
+
+    try:
+        with os.fdopen(fd, "w") as temp_file:
+            temp_file.write(content)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.unlink(temp_path)
+
+        raise
+
+
+class SnapshotPublisher:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.sequence = 0
+        self.orders_hash = None
+
+        try:
+            snapshot = read_snapshot(file_path)
+
+            self.sequence = snapshot["sequence"]
+            self.orders_hash = snapshot["hash"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def publish(self, orders):
+        orders_hash = hash_orders(orders)
+
+        if orders_hash == self.orders_hash:
+            return False
+
+        snapshot = {
+            "sequence": self.sequence + 1,
+            "hash": orders_hash,
+            "orders": orders,
+        }
+        write_atomically(self.file_path, json.dumps(snapshot, indent=4))
+
+        self.sequence = snapshot["sequence"]
+        self.orders_hash = orders_hash
+
+        return True
+
+
+class SnapshotWatcher:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file_stat = None
+        self.sequence = None
+
+    def poll(self):
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+
+        file_stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+        if file_stat == self.file_stat:
+            return None
+
+        snapshot = read_snapshot(self.file_path)
+        self.file_stat = file_stat
+
+        if snapshot["sequence"] == self.sequence:
+            return None
+
+        self.sequence = snapshot["sequence"]
+
+        return snapshot["orders"]
+
+
+async def publish_snapshots(topic, file_path, wakeup_path=None):
+    publisher = SnapshotPublisher(file_path)
+    version = 0
+
+    while True:
+        await topic.wait_newer(version)
+        version = topic.version
+
+        if publisher.publish(topic.value) and wakeup_path:
+            send_wakeup(wakeup_path)
+
+
+async def watch_snapshots(topics, interval_seconds, wakeup_path=None):
+    watchers = {file_path: SnapshotWatcher(file_path) for file_path in topics}
+    listener = WakeupListener(wakeup_path) if wakeup_path else None
+
+    try:
+        while True:
+            for file_path, watcher in watchers.items():
+                try:
+                    orders = watcher.poll()
+                except (OSError, ValueError, KeyError):
+                    logging.exception("Unable to read %s", file_path)
+
+                    continue
+
+                if orders is not None:
+                    topics[file_path].publish(orders)
+
+            if listener:
+                await listener.wait(interval_seconds)
+            else:
+                await asyncio.sleep(interval_seconds)
+    finally:
+        if listener:
+            listener.close()
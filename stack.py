@@ -1,90 +1,174 @@
 import unittest
+from random import Random
 from collections import Counter
 from operator import attrgetter
-from dataclasses import replace
 
 from vendus import InvoiceItem, InvoiceModifier
 
 
 def stack_items(items, sold_seperatly_references):
-    stacked_items = []
+    stacks = {}
+
+    def add(reference, price_cents, note, modifiers, quantity):
+        if quantity <= 0:
+            return
+
+        key = (reference, price_cents, note, modifiers)
+        stacks[key] = stacks.get(key, 0) + quantity
 
     for item in items:
-        for modifier in item.modifiers:
-            if modifier.reference in sold_seperatly_references:
-                sold_seperatly_item = InvoiceItem(
-                    reference=modifier.reference,
-                    price=modifier.price,
-                    quantity=modifier.quantity,
-                    note=modifier.note,
-                    modifiers=tuple(),
-                )
+        modifiers = item.modifiers
 
-                stacked_items.append(sold_seperatly_item)
+        if sold_seperatly_references and any(
+            modifier.reference in sold_seperatly_references for modifier in modifiers
+        ):
+            for modifier in modifiers:
+                if modifier.reference in sold_seperatly_references:
+                    add(
+                        modifier.reference,
+                        modifier.price_cents,
+                        modifier.note,
+                        (),
+                        modifier.quantity,
+                    )
 
-        item_without_sold_separately_modifiers = replace(
-            item,
-            modifiers=tuple(
+            modifiers = tuple(
                 modifier
-                for modifier in item.modifiers
+                for modifier in modifiers
                 if modifier.reference not in sold_seperatly_references
-            ),
-        )
-
-        stacked_items.append(item_without_sold_separately_modifiers)
-
-    expanded_items = []
-
-    for item in stacked_items:
-        for _ in range(item.quantity):
-            expanded_items.append(
-                replace(
-                    item,
-                    quantity=1,
-                )
             )
+        elif type(modifiers) is not tuple:
+            modifiers = tuple(modifiers)
 
-    items_counter = Counter(expanded_items)
+        add(item.reference, item.price_cents, item.note, modifiers, item.quantity)
 
     stacked_items = [
-        replace(item, quantity=count) for item, count in items_counter.items()
+        InvoiceItem(
+            reference=reference,
+            price_cents=price_cents,
+            quantity=quantity,
+            note=note,
+            modifiers=modifiers,
+        )
+        for (reference, price_cents, note, modifiers), quantity in stacks.items()
     ]
 
     return sorted(stacked_items, key=attrgetter("reference"))
 
 
 class TestStack(unittest.TestCase):
+    def expanded_stack_items(self, items, sold_seperatly_references):
+        stacked_items = []
+
+        for item in items:
+            for modifier in item.modifiers:
+                if modifier.reference in sold_seperatly_references:
+                    sold_seperatly_item = InvoiceItem(
+                        reference=modifier.reference,
+                        price_cents=modifier.price_cents,
+                        quantity=modifier.quantity,
+                        note=modifier.note,
+                        modifiers=tuple(),
+                    )
+
+                    stacked_items.append(sold_seperatly_item)
+
+            item_without_sold_separately_modifiers = InvoiceItem(
+                reference=item.reference,
+                price_cents=item.price_cents,
+                quantity=item.quantity,
+                note=item.note,
+                modifiers=tuple(
+                    modifier
+                    for modifier in item.modifiers
+                    if modifier.reference not in sold_seperatly_references
+                ),
+            )
+
+            stacked_items.append(item_without_sold_separately_modifiers)
+
+        expanded_items = []
+
+        for item in stacked_items:
+            for _ in range(item.quantity):
+                expanded_items.append(
+                    InvoiceItem(
+                        reference=item.reference,
+                        price_cents=item.price_cents,
+                        quantity=1,
+                        note=item.note,
+                        modifiers=item.modifiers,
+                    )
+                )
+
+        items_counter = Counter(expanded_items)
+
+        stacked_items = [
+            InvoiceItem(
+                reference=item.reference,
+                price_cents=item.price_cents,
+                quantity=count,
+                note=item.note,
+                modifiers=item.modifiers,
+            )
+            for item, count in items_counter.items()
+        ]
+
+        return sorted(stacked_items, key=attrgetter("reference"))
+
     def test_stack(self):
         items = [
             InvoiceItem(
                 reference="PEPSI",
                 quantity=1,
-                price=None,
+                price_cents=250,
                 modifiers=tuple(),
                 note="some note",
             ),
             InvoiceItem(
-                reference="PEPSI", quantity=1, price=None, modifiers=tuple(), note=None
+                reference="PEPSI",
+                quantity=1,
+                price_cents=250,
+                modifiers=tuple(),
+                note=None,
             ),
             InvoiceItem(
-                reference="PEPSI", quantity=1, price=None, modifiers=tuple(), note=None
+                reference="PEPSI",
+                quantity=1,
+                price_cents=250,
+                modifiers=tuple(),
+                note=None,
             ),
             InvoiceItem(
-                reference="COKE", quantity=1, price=None, modifiers=tuple(), note=None
+                reference="COKE",
+                quantity=1,
+                price_cents=250,
+                modifiers=tuple(),
+                note=None,
             ),
             InvoiceItem(
-                reference="COKE", quantity=2, price=None, modifiers=tuple(), note=None
+                reference="COKE",
+                quantity=2,
+                price_cents=250,
+                modifiers=tuple(),
+                note=None,
             ),
             InvoiceItem(
-                reference="PEPSI", quantity=1, price=2.0, modifiers=tuple(), note=None
+                reference="PEPSI",
+                quantity=1,
+                price_cents=200,
+                modifiers=tuple(),
+                note=None,
             ),
             InvoiceItem(
                 reference="FOOD",
                 quantity=1,
-                price=None,
+                price_cents=250,
                 note=None,
                 modifiers=[
-                    InvoiceModifier(reference="COKE", quantity=2, price=None, note=None)
+                    InvoiceModifier(
+                        reference="COKE", quantity=2, price_cents=250, note=None
+                    )
                 ],
             ),
         ]
@@ -93,19 +177,31 @@ class TestStack(unittest.TestCase):
 
         self.assertIn(
             InvoiceItem(
-                reference="COKE", quantity=5, price=None, modifiers=tuple(), note=None
+                reference="COKE",
+                quantity=5,
+                price_cents=250,
+                modifiers=tuple(),
+                note=None,
             ),
             stacked_items,
         )
         self.assertIn(
             InvoiceItem(
-                reference="PEPSI", quantity=2, price=None, modifiers=tuple(), note=None
+                reference="PEPSI",
+                quantity=2,
+                price_cents=250,
+                modifiers=tuple(),
+                note=None,
             ),
             stacked_items,
         )
         self.assertIn(
             InvoiceItem(
-                reference="PEPSI", quantity=1, price=2.0, modifiers=tuple(), note=None
+                reference="PEPSI",
+                quantity=1,
+                price_cents=200,
+                modifiers=tuple(),
+                note=None,
             ),
             stacked_items,
         )
@@ -113,7 +209,7 @@ class TestStack(unittest.TestCase):
             InvoiceItem(
                 reference="PEPSI",
                 quantity=1,
-                price=None,
+                price_cents=250,
                 modifiers=tuple(),
                 note="some note",
             ),
@@ -121,11 +217,47 @@ class TestStack(unittest.TestCase):
         )
         self.assertIn(
             InvoiceItem(
-                reference="FOOD", quantity=1, price=None, modifiers=tuple(), note=None
+                reference="FOOD",
+                quantity=1,
+                price_cents=250,
+                modifiers=tuple(),
+                note=None,
             ),
             stacked_items,
         )
 
+    def test_same_as_expanding_items(self):
+        random = Random(0)
+        references = ["PEPSI", "COKE", "FOOD", "WATER"]
+
+        def random_modifier():
+            return InvoiceModifier(
+                reference=random.choice(references),
+                quantity=random.randint(0, 3),
+                price_cents=random.choice([0, 150]),
+                note=random.choice([None, "ice"]),
+            )
+
+        def random_item():
+            return InvoiceItem(
+                reference=random.choice(references),
+                quantity=random.randint(0, 40),
+                price_cents=random.choice([250, 200]),
+                note=random.choice([None, None, "some note"]),
+                modifiers=random.choice([tuple, list])(
+                    random_modifier() for _ in range(random.randint(0, 2))
+                ),
+            )
+
+        for _ in range(500):
+            items = [random_item() for _ in range(random.randint(0, 12))]
+            sold_seperatly_references = set(random.sample(references, 2))
+
+            self.assertEqual(
+                stack_items(items, sold_seperatly_references),
+                self.expanded_stack_items(items, sold_seperatly_references),
+            )
+
 
 if __name__ == "__main__":
     unittest.main()
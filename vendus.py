@@ -1,26 +1,87 @@
-from typing import Tuple
 from dataclasses import dataclass, asdict
 from datetime import datetime
+import asyncio
 import base64
 import logging
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter, Retry
+
+from metrics import track_async_api_request
+
+
+def format_cents(cents):
+    sign = "-" if cents < 0 else ""
+    units, remainder = divmod(abs(cents), 100)
+
+    return f"{sign}{units}.{remainder:02d}"
 
 
-@dataclass(frozen=True, eq=True)
 class InvoiceModifier:
-    reference: str
-    price: float
-    quantity: int
-    note: str
+    __slots__ = ("reference", "price_cents", "quantity", "note")
+
+    def __init__(self, reference, price_cents, quantity, note):
+        self.reference = reference
+        self.price_cents = price_cents
+        self.quantity = quantity
+        self.note = note
+
+    def _key(self):
+        return (self.reference, self.price_cents, self.quantity, self.note)
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return f"InvoiceModifier{self._key()!r}"
 
 
-@dataclass(frozen=True, eq=True)
 class InvoiceItem:
-    reference: str
-    price: float
-    quantity: int
-    note: str
-    modifiers: Tuple[InvoiceModifier]
+    __slots__ = ("reference", "price_cents", "quantity", "note", "modifiers")
+
+    def __init__(self, reference, price_cents, quantity, note, modifiers):
+        self.reference = reference
+        self.price_cents = price_cents
+        self.quantity = quantity
+        self.note = note
+        self.modifiers = modifiers
+
+    def _key(self):
+        return (
+            self.reference,
+            self.price_cents,
+            self.quantity,
+            self.note,
+            self.modifiers,
+        )
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return f"InvoiceItem{self._key()!r}"
+
+    def unit_price_cents(self):
+        return self.price_cents + sum(
+            modifier.price_cents * modifier.quantity for modifier in self.modifiers
+        )
+
+
+def total_cents(invoice_items):
+    return sum(item.unit_price_cents() * item.quantity for item in invoice_items)
 
 
 @dataclass(frozen=True, eq=True)
@@ -32,16 +93,73 @@ class _VendusItem:
 
 
 class VendusClient:
-    def __init__(self, api_key):
+    def __init__(
+        self,
+        api_key,
+        pool_size=10,
+        timeout=(3.05, 20),
+        retries=5,
+        base_url="https://www.vendus.pt",
+    ):
         self.api_key = api_key
-
+        self.timeout = timeout
+
+        self.retry_config = Retry(
+            total=retries,
+            backoff_factor=0.2,
+            status_forcelist=frozenset({500, 502, 503, 504}),
+            allowed_methods=frozenset({"GET"}),
+            respect_retry_after_header=False,
+        )
+        self.backoff_seconds = sum(
+            self.retry_config.backoff_factor * 2 ** (errors - 1)
+            for errors in range(2, retries + 1)
+        )
+        self.call_deadline = threading.local()
         self.session = requests.Session()
+        self.session.mount(
+            base_url,
+            HTTPAdapter(
+                max_retries=self.retry_config,
+                pool_connections=1,
+                pool_maxsize=pool_size,
+                pool_block=True,
+            ),
+        )
         self.session.params.update({"api_key": self.api_key})
 
         self.duplicated_nif_error_code = "A001"
 
-        self.client_url = "https://www.vendus.pt/ws/v1.1/clients/"
-        self.document_url = "https://www.vendus.pt/ws/v1.1/documents/"
+        self.client_url = f"{base_url}/ws/v1.1/clients/"
+        self.document_url = f"{base_url}/ws/v1.1/documents/"
+
+    def call_with_deadline(self, deadline, method, *args, **kwargs):
+        self.call_deadline.value = deadline
+
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self.call_deadline.value = None
+
+    def _timeout(self):
+        deadline = getattr(self.call_deadline, "value", None)
+
+        if deadline is None:
+            return self.timeout
+
+        attempt_seconds = (deadline - time.monotonic() - self.backoff_seconds) / (
+            self.retry_config.total + 1
+        )
+
+        if attempt_seconds <= 0:
+            raise requests.Timeout("Vendus call deadline exceeded")
+
+        connect_timeout, read_timeout = self.timeout
+
+        return (
+            min(connect_timeout, attempt_seconds),
+            min(read_timeout, attempt_seconds),
+        )
 
     def search_client(self, *, nif=None, name=None, external_reference=None):
         if not any([nif, name, external_reference]):
@@ -53,7 +171,9 @@ class VendusClient:
             "external_reference": external_reference,
         }
 
-        response = self.session.get(self.client_url, params=search_params)
+        response = self.session.get(
+            self.client_url, params=search_params, timeout=self._timeout()
+        )
 
         if response.status_code == 404:
             return []
@@ -86,7 +206,9 @@ class VendusClient:
         if external_reference:
             client_resource["external_reference"] = external_reference
 
-        response = self.session.post(self.client_url, json=client_resource)
+        response = self.session.post(
+            self.client_url, json=client_resource, timeout=self._timeout()
+        )
         response.raise_for_status()
 
         created_client = response.json()
@@ -103,13 +225,53 @@ class VendusClient:
         invoice["local_time"] = self._parse_time(invoice["local_time"])
         invoice["date"] = self._parse_date(invoice["date"])
 
-    def get_invoices(self):
-        response = self.session.get(self.document_url)
-        response.raise_for_status()
-        invoices = response.json()
+    def get_invoices(
+        self,
+        since=None,
+        per_page=100,
+        register_id=None,
+        external_reference=None,
+        newer_than_id=None,
+    ):
+        params = {"per_page": per_page}
+
+        if since:
+            params["since"] = since.isoformat()
+        if register_id:
+            params["register_id"] = register_id
+        if external_reference:
+            params["external_reference"] = external_reference
+
+        invoices = []
+        page = 1
+
+        while True:
+            response = self.session.get(
+                self.document_url,
+                params={**params, "page": page},
+                timeout=self._timeout(),
+            )
+
+            if response.status_code == 404:
+                break
+
+            response.raise_for_status()
+            page_invoices = response.json()
+
+            for invoice in page_invoices:
+                self._parse_invoice(invoice)
 
-        for invoice in invoices:
-            self._parse_invoice(invoice)
+            invoices.extend(page_invoices)
+
+            if len(page_invoices) < per_page:
+                break
+
+            if newer_than_id is not None and any(
+                invoice["id"] <= newer_than_id for invoice in page_invoices
+            ):
+                break
+
+            page += 1
 
         return invoices
 
@@ -117,7 +279,9 @@ class VendusClient:
         resource_url = self.document_url + str(invoice_id)
         params = {"output": "escpos"}
 
-        response = self.session.get(resource_url, params=params)
+        response = self.session.get(
+            resource_url, params=params, timeout=self._timeout()
+        )
         response.raise_for_status()
 
         invoice_resource = response.json()
@@ -128,7 +292,7 @@ class VendusClient:
     def get_invoice_details(self, invoice_id):
         resource_url = self.document_url + str(invoice_id)
 
-        response = self.session.get(resource_url)
+        response = self.session.get(resource_url, timeout=self._timeout())
         try:
             response.raise_for_status()
         except requests.HTTPError:
@@ -213,7 +377,6 @@ class VendusClient:
         )
 
     def _build_item(self, invoice_item):
-        price = invoice_item.price
         note = "\n".join(
             filter(
                 is_not_empty := bool,
@@ -221,12 +384,9 @@ class VendusClient:
             )
         )
 
-        for modifier in invoice_item.modifiers:
-            price += modifier.price * modifier.quantity
-
         return _VendusItem(
             reference=invoice_item.reference,
-            gross_price=str(round(price, 2)),
+            gross_price=format_cents(invoice_item.unit_price_cents()),
             qty=invoice_item.quantity,
             text=note if note else None,
         )
@@ -254,7 +414,9 @@ class VendusClient:
         if notes:
             invoice_resource["notes"] = notes
 
-        response = self.session.post(self.document_url, json=invoice_resource)
+        response = self.session.post(
+            self.document_url, json=invoice_resource, timeout=self._timeout()
+        )
         try:
             response.raise_for_status()
         except requests.HTTPError:
@@ -263,3 +425,82 @@ class VendusClient:
             raise
 
         return response.json()
+
+
+class AsyncVendusClient:
+    def __init__(
+        self,
+        api_key,
+        pool_size=4,
+        deadline_seconds=30,
+        deadline_margin_seconds=1,
+        retries=2,
+        base_url="https://www.vendus.pt",
+    ):
+        self.client = VendusClient(
+            api_key, pool_size=pool_size, retries=retries, base_url=base_url
+        )
+        self.deadline_seconds = deadline_seconds
+        self.deadline_margin_seconds = deadline_margin_seconds
+
+        self.requests_limit = asyncio.Semaphore(pool_size)
+
+    def _release_request(self, request):
+        self.requests_limit.release()
+
+        if not request.cancelled():
+            request.exception()
+
+    async def _call(self, method, *args, **kwargs):
+        await self.requests_limit.acquire()
+
+        deadline = (
+            time.monotonic() + self.deadline_seconds - self.deadline_margin_seconds
+        )
+        request = asyncio.ensure_future(
+            asyncio.to_thread(
+                self.client.call_with_deadline, deadline, method, *args, **kwargs
+            )
+        )
+        request.add_done_callback(self._release_request)
+
+        return await track_async_api_request(
+            "vendus",
+            method.__name__,
+            lambda: asyncio.wait_for(asyncio.shield(request), self.deadline_seconds),
+        )
+
+    async def search_client(self, **search_params):
+        return await self._call(self.client.search_client, **search_params)
+
+    async def create_client(self, **client_values):
+        return await self._call(self.client.create_client, **client_values)
+
+    async def guess_client(self, nif, mobile, name):
+        return await self._call(self.client.guess_client, nif, mobile, name)
+
+    async def invoice(self, invoice_items, **invoice_params):
+        return await self._call(self.client.invoice, invoice_items, **invoice_params)
+
+    async def get_talao(self, invoice_id):
+        return await self._call(self.client.get_talao, invoice_id)
+
+    async def get_invoices(
+        self,
+        since=None,
+        per_page=100,
+        register_id=None,
+        external_reference=None,
+        newer_than_id=None,
+    ):
+        return await self._call(
+            self.client.get_invoices,
+            since,
+            per_page,
+            register_id,
+            external_reference,
+            newer_than_id,
+        )
+
+    async def get_invoice_details(self, invoice_id):
+        return await self._call(self.client.get_invoice_details, invoice_id)
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import socket
+
+PRINTING_WAKEUP_PATH = "printing.sock"
+FEED_WAKEUP_PATH = "feed.sock"
+
+
+def send_wakeup(socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as wakeup_socket:
+        wakeup_socket.setblocking(False)
+
+        try:
+            wakeup_socket.sendto(b"\0", socket_path)
+        except (FileNotFoundError, ConnectionRefusedError, BlockingIOError):
+            pass
+
+
+class WakeupListener:
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+
+        try:
+            os.unlink(socket_path)
+        except FileNotFoundError:
+            pass
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(socket_path)
+        self.socket.setblocking(False)
+
+    def drain(self):
+        while True:
+            try:
+                self.socket.recv(64)
+            except BlockingIOError:
+                return
+
+    async def wait(self, timeout=None):
+        loop = asyncio.get_running_loop()
+        woken = loop.create_future()
+
+        def on_readable():
+            if not woken.done():
+                woken.set_result(True)
+
+        loop.add_reader(self.socket, on_readable)
+
+        try:
+            await asyncio.wait_for(woken, timeout)
+
+            was_woken = True
+        except asyncio.TimeoutError:
+            was_woken = False
+        finally:
+            loop.remove_reader(self.socket)
+
+        self.drain()
+
+        return was_woken
+
+    def close(self):
+        self.socket.close()
+
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+
+async def watch_wakeups(socket_path, topic):
+    listener = WakeupListener(socket_path)
+
+    try:
+        while True:
+            if await listener.wait():
+                topic.publish(None)
+    finally:
+        listener.close()
+
+
+async def signal_wakeups(topic, socket_path):
+    version = topic.version
+
+    while True:
+        await topic.wait_newer(version)
+        version = topic.version
+
+        send_wakeup(socket_path)